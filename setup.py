@@ -6,7 +6,7 @@ setup(
  version='0.2',
  packages=['csv2ofx'],
  package_dir={'csv2ofx':'src/csv2ofx'},
- scripts=['csv2ofx'],
+ scripts=['csv2ofx','csv2ofx-batch','csv2ofx-bench'],
  package_data={'csv2ofx':['*.xrc']}
 )
 
@@ -0,0 +1,144 @@
+
+"""
+    Exact amounts.
+
+    Amounts are parsed once into integer cents (Cents), so changing the
+    sign, telling credits from debits and adding them up is exact integer
+    arithmetic.  A Cents prints as the decimal amount, so the exporters
+    write it like any other value.
+"""
+
+import re
+from string import maketrans
+
+# the currency symbols left out of amounts: $ and the latin-1 (cp1252
+# for the euro) pound, yen, euro and currency sign
+_symbols = '$\xa3\xa5\x80\xa4'
+# the utf-8 euro, pound, yen, currency sign and no-break space
+_utf8_symbols = re.compile('\xe2\x82\xac|\xc2[\xa3\xa5\xa4\xa0]')
+_spaces = ' \t\r\n\xa0'
+# the thousands separators of each decimal point
+_separators = {'.': "',", ',': "'."}
+# the translate arguments for each decimal point, which becomes '.'
+_tables = dict([(decimal, (maketrans(decimal,'.'), _symbols + _spaces + _separators[decimal]))
+                for decimal in '.,'])
+# a thousands separator that isn't followed by a group of three digits,
+# e.g. the ',' of '12,50' when the decimal point is '.'
+_bad_groups = dict([(decimal, re.compile(r"[%s](?!\d{3}(?!\d))" % re.escape(_separators[decimal])))
+                    for decimal in '.,'])
+# a cleaned amount: sign or parentheses, digits, sign or parenthesis
+_amount = re.compile(r'(\(?)([-+]?)(\d*)(?:\.(\d*))?(-?)(\)?)\Z')
+
+
+class Cents(int):
+    """
+        An amount in integer cents that prints as the decimal amount,
+        e.g. str(Cents(-123450)) == '-1234.50'.  Adding, subtracting and
+        negating Cents gives Cents.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        # exact: a double holds any amount under 10**13 to far better than a cent
+        return '%.2f' % (self/100.0)
+
+    def __repr__(self):
+        return 'Cents(%d)' % self
+
+    def __neg__(self):
+        return Cents(-int(self))
+
+    def __add__(self,other):
+        if isinstance(other,(int,long)):
+            return Cents(int(self)+other)
+        return NotImplemented
+    __radd__ = __add__
+
+    def __sub__(self,other):
+        if isinstance(other,(int,long)):
+            return Cents(int(self)-other)
+        return NotImplemented
+
+    def __rsub__(self,other):
+        if isinstance(other,(int,long)):
+            return Cents(other-int(self))
+        return NotImplemented
+
+
+def parse_cents(text,decimal='.'):
+    """
+        The amount text of a csv file in Cents.
+
+        decimal: the decimal point, '.' or ','
+        Currency symbols, spaces and the thousands separators (' and ','
+        or '.', the one that isn't the decimal point) are left out.  '-'
+        before or after the amount and parentheses around it make it
+        negative.  Digits past the cents are rounded half away from zero.
+        Raises ValueError for text that isn't an amount: any other
+        character, e.g. a letter, or a thousands separator that isn't
+        followed by three digits, like the other decimal point.
+
+        >>> parse_cents("1'234.50"), parse_cents('-$20.00'), parse_cents('(3.5)')
+        (Cents(123450), Cents(-2000), Cents(-350))
+        >>> parse_cents('1.234,5', ','), parse_cents('12,50 \xe2\x82\xac', ',')
+        (Cents(123450), Cents(1250))
+        >>> parse_cents('1e5')
+        Traceback (most recent call last):
+        ValueError: Not an amount: '1e5'
+        >>> parse_cents('abc12')
+        Traceback (most recent call last):
+        ValueError: Not an amount: 'abc12'
+        >>> parse_cents('12,50')
+        Traceback (most recent call last):
+        ValueError: Not an amount: '12,50'
+        >>> parse_cents('1,5')
+        Traceback (most recent call last):
+        ValueError: Not an amount: '1,5'
+        >>> parse_cents('12.50', ',')
+        Traceback (most recent call last):
+        ValueError: Not an amount: '12.50'
+    """
+    if _bad_groups[decimal].search(text):
+        raise ValueError("Not an amount: %r" % text)
+    table, deleted = _tables[decimal]
+    amount = text.translate(table,deleted)
+    # most amounts are like -1234.50 by now
+    if amount[-3:-2] == '.':
+        try:
+            return Cents(int(amount[:-3] + amount[-2:]))
+        except ValueError:
+            pass
+    match = _amount.match(amount)
+    if match is None:
+        # utf-8 currency symbols are several bytes, rarely used
+        match = _amount.match(_utf8_symbols.sub('',text).translate(table,deleted))
+        if match is None:
+            raise ValueError("Not an amount: %r" % text)
+    open_paren, sign, units, fraction, minus, close_paren = match.groups()
+    fraction = fraction or ''
+    if not (units or fraction) or bool(open_paren) != bool(close_paren):
+        raise ValueError("Not an amount: %r" % text)
+    cents = int(units or '0')*100 + int(fraction[:2].ljust(2,'0'))
+    if fraction[2:3] >= '5':
+        cents += 1
+    if open_paren or '-' in (sign, minus):
+        cents = -cents
+    return Cents(cents)
+
+def to_cents(value):
+    """
+        value in Cents, parsed if it is a string (see parse_cents).
+    """
+    if isinstance(value,Cents):
+        return value
+    if isinstance(value,basestring):
+        return parse_cents(value)
+    if isinstance(value,float):
+        return Cents(int(round(value*100)))
+    return Cents(value*100)
+
+def transaction_type(amount):
+    """
+        'CREDIT' for an amount over 0, else 'DEBIT'.
+    """
+    return to_cents(amount) > 0 and 'CREDIT' or 'DEBIT'
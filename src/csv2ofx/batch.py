@@ -0,0 +1,339 @@
+
+"""
+    Headless batch conversion.
+
+    Converts any number of csv files to OFX or QIF in a single process
+    without importing wx, e.g.:
+
+    csv2ofx-batch --mapping Yodlee --format OFX in/*.csv -o out/
+
+    Without --mapping the mapping of each file is found from its header
+    (see registry.detect_mapping).  --merge writes one file per account
+    with the transactions of all the csv files, see merge.py.  --since
+    and --until convert only the transactions of those dates.  --format
+    OFX,QIF writes both formats in one pass over each file, see multi.py.
+"""
+
+import sys, os
+from datetime import datetime, timedelta
+from optparse import OptionParser
+from traceback import print_exc, format_exc
+
+from csvutils import CSVTable, CSVStream
+from columns import ColumnarCSVTable
+from mapped import MappedCSVTable
+from registry import load_mappings, detect_mapping
+from merge import merge_files, KEYS
+import ofx, qif, multi
+import timing
+
+
+EXPORTERS = {'OFX':ofx.export, 'QIF':qif.export}
+
+# how the rows of a file are held, see open_table
+TABLES = {'rows':CSVTable, 'columns':ColumnarCSVTable, 'mapped':MappedCSVTable,
+          'stream':CSVStream}
+
+
+def open_table(csv_path, mapping, storage='rows', since=None, until=None):
+    """
+        Loads csv_path using the delimiter and skip_last _params of mapping.
+
+        storage: 'rows' loads the file as a list of rows, 'columns' loads
+            it in compact columns (see columns.py), 'mapped' parses the rows
+            of the memory mapped file as needed (see mapped.py) and 'stream'
+            reads the rows one at a time instead of loading the file
+        since, until: datetimes, only the rows of the dates from since to
+            until are read (either may be None), see CSVTable
+    """
+    params = mapping['_params']
+    table = TABLES[storage]
+    return table(csv_path, mapping, params.get('delimiter',','), params.get('skip_last',0),
+                 since, until)
+
+
+def output_path(csv_path, format, out_dir=None, taken=None):
+    """
+        The export file name for csv_path, placed in out_dir if given.
+
+        taken: the lower case absolute paths given to other csv files,
+            e.g. a/stmt.csv and b/stmt.csv are both stmt.ofx in out_dir,
+            so the second is stmt-2.ofx.  The path is added to taken.
+    """
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    if out_dir is None:
+        out_dir = os.path.dirname(csv_path)
+    path = os.path.join(out_dir, "%s.%s" % (name, format.lower()))
+    if taken is not None:
+        number = 1
+        while os.path.abspath(path).lower() in taken:
+            number += 1
+            path = os.path.join(out_dir, "%s-%d.%s" % (name, number, format.lower()))
+        taken.add(os.path.abspath(path).lower())
+    return path
+
+def output_paths(csv_path, format, out_dir=None, taken=None):
+    """
+        The export file name for csv_path in format, see output_path, or
+        {format: file name} for several formats ('OFX,QIF').
+    """
+    if format in EXPORTERS:
+        return output_path(csv_path, format, out_dir, taken)
+    return dict([(name, output_path(csv_path, name, out_dir, taken)) for name in format.split(',')])
+
+
+def convert(csv_path, mapping, format, path, storage='rows', state=None, since=None, until=None,
+            **export_options):
+    """
+        Converts one csv file.
+
+        csv_path: the csv file to read
+        mapping: mapping selected from all_mappings
+        format: 'OFX' or 'QIF', or 'OFX,QIF' to export both in one pass
+        path: path to save the file, {format: path} for 'OFX,QIF'
+        storage: how the rows are held, see open_table
+        state: StateStore for format, converts incrementally: a file
+            converted before is skipped and only the transactions not
+            exported before are written
+        since, until: convert only the transactions of these dates, see
+            open_table.  The OFX statement covers since and until if given.
+        export_options: passed on to the exporter, e.g. jobs or compact (OFX)
+
+        Returns False if the file was skipped.
+    """
+    if state is not None:
+        from state import file_digest
+        digest = file_digest(csv_path)
+        if state.converted(digest):
+            print "Unchanged %s" % csv_path
+            return False
+        export_options = dict(export_options, state=state)
+    grid = open_table(csv_path, mapping, storage, since, until)
+    maptype = mapping['_params'].get('maptype','bank')
+    try:
+        if format in EXPORTERS:
+            EXPORTERS[format](path, mapping[format], maptype, grid, **export_options)
+        else:
+            multi.export(path, mapping, maptype, grid, **export_options)
+    except:
+        if state is not None:
+            state.rollback()
+        raise
+    if state is not None:
+        state.commit(digest)
+    return True
+
+
+# the mappings and the StateStore of a worker process, see _init_worker
+_worker_mappings = None
+_worker_state = None
+
+def _init_worker(state_path=None, format=None):
+    global _worker_mappings, _worker_state
+    _worker_mappings = load_mappings()
+    _worker_state = None
+    if state_path is not None:
+        from state import StateStore
+        _worker_state = StateStore(state_path, format)
+
+def _convert_job(job):
+    """
+        Converts one file in a worker process.  The mapping is passed
+        by name since mappings (lambdas) can't be pickled.
+    """
+    csv_path, mapping_name, format, path, storage, since, until, export_options = job
+    try:
+        if mapping_name is None:
+            mapping_name = detect_mapping(csv_path, _worker_mappings)
+        if not convert(csv_path, _worker_mappings[mapping_name], format, path, storage,
+                       _worker_state, since, until, **export_options):
+            path = None
+        return csv_path, path, None
+    except:
+        return csv_path, path, format_exc()
+
+
+def convert_files(csv_paths, mapping_name, format, out_dir=None, storage='rows', jobs=1,
+                  export_options={}, state_path=None, since=None, until=None):
+    """
+        Converts many csv files with the mapping named mapping_name, or
+        the mapping each file's header fits if mapping_name is None.
+
+        jobs: number of worker processes, 1 converts in this process
+        export_options: passed on to the exporter, see convert.  The
+            exporter's own jobs only work when jobs is 1.
+        state_path: the StateStore file for an incremental conversion,
+            see convert.  Use with jobs 1, the worker processes would not
+            see the transactions the others export.
+        since, until: convert only the transactions of these dates, see
+            convert
+
+        Generates (csv_path, path, error) for each file in the order of
+        csv_paths, error is the formatted exception or None.  path is
+        None for a file skipped since it was converted before.  Files that
+        would be exported to the same path get numbered names, see
+        output_path.
+    """
+    # the paths taken, in lower case for case insensitive file systems
+    taken = set()
+    jobs_list = [(csv_path, mapping_name, format, output_paths(csv_path, format, out_dir, taken), storage,
+                  since, until, export_options)
+                 for csv_path in csv_paths]
+    if jobs <= 1:
+        _init_worker(state_path, format)
+        try:
+            for job in jobs_list:
+                yield _convert_job(job)
+        finally:
+            if _worker_state is not None:
+                _worker_state.close()
+        return
+    # multiprocessing and sqlite3 (see state.py) are only imported when
+    # they are used, they are slow to import for the many short runs
+    from multiprocessing import Pool
+    pool = Pool(jobs, _init_worker, (state_path, format))
+    try:
+        for result in pool.imap(_convert_job, jobs_list):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def merge_convert(csv_paths, mapping_name, format, out_dir, storage='rows', key='hash', compact=False,
+                  since=None, until=None):
+    """
+        Merges the transactions of csv_paths into one file per account
+        in out_dir, every transaction once (see merge.merge_files).  The
+        mapping is found from each file's header if mapping_name is None.
+        since, until: merge only the transactions of these dates
+
+        Returns (account, path, transactions, duplicates) for each account.
+    """
+    all_mappings = load_mappings()
+    def tables():
+        for csv_path in csv_paths:
+            mapping = all_mappings[mapping_name or detect_mapping(csv_path, all_mappings)]
+            yield mapping, open_table(csv_path, mapping, storage, since, until)
+    return merge_files(tables(), format, out_dir, key, compact, since, until)
+
+
+# the format of the --since and --until dates
+DAY_FORMAT = '%Y-%m-%d'
+
+def parse_day(parser, option, value, end=False):
+    """
+        The datetime of the start of the day value of option, of its last
+        moment with end (so the rows of that day with a time are within
+        until), a parser error if it isn't a YYYY-MM-DD date.
+    """
+    if value is None:
+        return None
+    try:
+        day = datetime.strptime(value, DAY_FORMAT)
+    except ValueError:
+        parser.error("%s must be a date like 2024-01-31, not %s" % (option, value))
+    if end:
+        return day + timedelta(days=1) - timedelta.resolution
+    return day
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [--mapping NAME] [options] file.csv ...")
+    parser.add_option("-m", "--mapping",
+                      help="mapping name (see --list) [default: found from the header of each file]")
+    parser.add_option("-f", "--format", default="OFX",
+                      help="export format, OFX or QIF, or OFX,QIF for both from one pass "
+                           "over the rows [default: %default]")
+    parser.add_option("-o", "--output", metavar="DIR",
+                      help="output directory [default: next to each csv file]")
+    parser.add_option("-S", "--storage", default="rows", choices=TABLES.keys(),
+                      help="how the rows of each file are held: rows, columns (less memory), "
+                           "mapped (memory mapped) or stream (bounded memory) [default: %default]")
+    parser.add_option("-s", "--stream", action="store_const", dest="storage", const="stream",
+                      help="same as --storage stream, for very large files")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+                      help="convert with JOBS worker processes, 0 for one per cpu [default: %default]")
+    parser.add_option("-J", "--row-jobs", type="int", default=1,
+                      help="map the rows of each file with ROW_JOBS worker processes, "
+                           "for very large files [default: %default]")
+    parser.add_option("-c", "--compact", action="store_true",
+                      help="write OFX without the pretty print whitespace")
+    parser.add_option("-i", "--state", metavar="FILE",
+                      help="convert incrementally, skip the csv files converted before and "
+                           "export only the transactions not exported before, as recorded in FILE")
+    parser.add_option("-M", "--merge", action="store_true",
+                      help="merge the csv files (overlapping statements) into one file per "
+                           "account, leaving out the transactions already in another file")
+    parser.add_option("-k", "--key", default="hash", choices=KEYS,
+                      help="with --merge, a transaction is a duplicate if its hash of date, "
+                           "amount and payee or its fitid is the same [default: %default]")
+    parser.add_option("--since", metavar="YYYY-MM-DD",
+                      help="convert only the transactions of this date and later")
+    parser.add_option("--until", metavar="YYYY-MM-DD",
+                      help="convert only the transactions of this date and earlier")
+    parser.add_option("-p", "--profile", metavar="FILE",
+                      help="write the time spent in each stage and mapping field to FILE "
+                           "as JSON, like setting CSV2OFX_PROFILE (see timing.py)")
+    parser.add_option("-l", "--list", action="store_true", help="list the available mappings")
+    options, args = parser.parse_args(argv)
+
+    all_mappings = load_mappings()
+    if options.list:
+        for name in sorted(all_mappings):
+            print name
+        return 0
+    if options.mapping is not None and options.mapping not in all_mappings:
+        parser.error("unknown mapping: %s" % options.mapping)
+    if not args:
+        parser.error("no csv files given")
+    if options.output and not os.path.isdir(options.output):
+        os.makedirs(options.output)
+
+    formats = options.format.upper().split(',')
+    if not formats or [format for format in formats if format not in EXPORTERS]:
+        parser.error("unknown format: %s" % options.format)
+    format = ','.join([format for format in multi.FORMATS if format in formats])
+
+    jobs, row_jobs = options.jobs, options.row_jobs
+    if not (jobs and row_jobs):
+        from multiprocessing import cpu_count
+        jobs, row_jobs = jobs or cpu_count(), row_jobs or cpu_count()
+    if jobs > 1 and row_jobs > 1:
+        parser.error("--jobs and --row-jobs can't be combined")
+    if options.state and (jobs > 1 or row_jobs > 1):
+        parser.error("--state can't be combined with --jobs or --row-jobs")
+    if options.merge and (options.state or jobs > 1 or row_jobs > 1):
+        parser.error("--merge can't be combined with --state, --jobs or --row-jobs")
+    if format not in EXPORTERS and (options.state or options.merge or row_jobs > 1):
+        parser.error("--format %s can't be combined with --state, --merge or --row-jobs" % format)
+    since = parse_day(parser, '--since', options.since)
+    until = parse_day(parser, '--until', options.until, end=True)
+    if since and until and since > until:
+        parser.error("--since is after --until")
+    export_options = {'jobs':row_jobs}
+    if options.compact:
+        if 'OFX' not in formats:
+            parser.error("--compact is only for OFX")
+        export_options['compact'] = True
+
+    if options.profile:
+        timing.enable(options.profile)
+
+    if options.merge:
+        for account, path, count, duplicates in merge_convert(
+                args, options.mapping, format, options.output or os.curdir,
+                options.storage, options.key, options.compact, since, until):
+            print "%s: %d transactions, %d duplicates left out" % (path, count, duplicates)
+        return 0
+
+    failed = 0
+    for csv_path, path, error in convert_files(args, options.mapping, format,
+                                               options.output, options.storage, jobs, export_options,
+                                               options.state, since, until):
+        if error:
+            print >>sys.stderr, "Failed to convert %s" % csv_path
+            print >>sys.stderr, error
+            failed += 1
+    return failed and 1 or 0
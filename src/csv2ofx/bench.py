@@ -0,0 +1,346 @@
+
+"""
+    Conversion benchmarks.
+
+    Generates synthetic csv statements with the column layout of each
+    built in mapping and measures the rows per second of the three stages
+    of a conversion:
+
+        load: reading the csv file into a table (see batch.open_table)
+        map: evaluating the mapping fields for every row
+        write: the export to a file, mapping the rows again
+
+    and the peak memory of the whole conversion (the stages run in one
+    process, so their peaks can't be told apart).  Each mapping, size and
+    format is measured in a new process so the peak memory of one run does
+    not hide the next.  No wx is needed, e.g.:
+
+    csv2ofx-bench --rows 10000,1000000 --mapping Yodlee --format OFX
+
+    --startup measures the time to the first conversion instead: running
+    csv2ofx-batch on a small statement in a new python, as from cron.
+    The target is STARTUP_TARGET.
+"""
+
+import sys, os
+import csv
+import random
+import tempfile
+import time
+import subprocess
+import shutil
+from datetime import date, timedelta
+from optparse import OptionParser
+from multiprocessing import Process, Pipe
+from traceback import format_exc
+
+try:
+    import resource
+except ImportError:
+    # no peak memory on this platform
+    resource = None
+
+from fields import compile_field, compile_mapping
+import mappings
+import batch
+import ofx, qif
+
+# the default statement sizes
+ROWS = (10000, 1000000, 10000000)
+# seconds from starting python to the first converted file, see startup_time
+STARTUP_TARGET = 0.1
+# rows of the statement converted by startup_time
+STARTUP_ROWS = 100
+# runs csv2ofx-batch like the script does
+BATCH_SCRIPT = "import sys; from csv2ofx import batch; sys.exit(batch.main())"
+
+
+# the generators return (header, rows, footer) for a statement of n rows,
+# rows generates the data rows and footer the rows skip_last leaves out
+
+def _dates(rnd, fmt):
+    start = date(2009,1,1)
+    dates = [(start+timedelta(days)).strftime(fmt) for days in xrange(730)]
+    return lambda: rnd.choice(dates)
+
+def _amount(rnd):
+    return '%.2f' % rnd.uniform(-500,500)
+
+PAYEES = ['SAFEWAY', 'SHELL OIL 5521', 'AMAZON MKTPLACE', 'PAYROLL ACME & CO',
+          'CITY WATER <UTIL>', 'CAFE "LE COIN"', 'TRANSFER TO SAVINGS', 'RENT']
+
+def gen_yodlee(rnd, n):
+    header = ['Status','Date','Original Description','User Description','Split Type',
+              'Category','Currency','Amount','User Description','Memo','Classification',
+              'Account Name','Simple Description','Transaction Id']
+    day = _dates(rnd,'%m/%d/%Y')
+    accounts = ['Bank of X - 1234','Bank of Y - 999','Card Z - 55']
+    def rows():
+        row = 0
+        while row < n:
+            account = rnd.choice(accounts)
+            d = day()
+            yield ['posted',d,rnd.choice(PAYEES),rnd.random()<0.2 and 'note' or '','',
+                   'Groceries','USD',_amount(rnd),'','','Personal',account,'S','t%d' % row]
+            row += 1
+            # some transactions are split
+            if rnd.random() < 0.05:
+                for s in xrange(min(2,n-row)):
+                    yield ['posted',d,'SPLIT','','Split','Misc','USD',_amount(rnd),'',
+                           'part %d' % s,'Personal',account,'S','t%d' % row]
+                    row += 1
+    return header, rows(), []
+
+def gen_cu(rnd, n):
+    header = ['Date','Description','Comments','Check Number','Amount']
+    day = _dates(rnd,'%m/%d/%Y')
+    def rows():
+        for row in xrange(n):
+            amount = _amount(rnd)
+            check = rnd.random()<0.1 and str(1000+row) or ''
+            yield [day(),rnd.choice(PAYEES),'c%d' % (row%100),check,
+                   amount.startswith('-') and '-$'+amount[1:] or '$'+amount]
+    return header, rows(), []
+
+def gen_ubs(rnd, n):
+    header = ['Trade date','Trade time','Booking date','Value date','Ccy.','Debit','Credit',
+              'Balance','Entered by','Recipient','Description','Description 1',
+              'Description 2','Description 3']
+    day = _dates(rnd,'%d.%m.%Y')
+    def rows():
+        for row in xrange(n):
+            d = day()
+            amount = "%d'%03d.%02d" % (rnd.randint(0,9),rnd.randint(0,999),rnd.randint(0,99))
+            debit, credit = rnd.random()<0.7 and (amount,'') or ('',amount)
+            yield [d,'',d,d,'CHF',debit,credit,'',rnd.random()<0.3 and 'Me' or '',
+                   rnd.choice(PAYEES),'Acct A','Card','',rnd.random()<0.5 and 'x' or '']
+    return header, rows(), [['total']+['']*13]
+
+def gen_msmoney(rnd, n):
+    header = ['Date','Num','Payee','Account','Account Name','Split Type','Category',
+              'Projects','Memo','C','Amount','Currency']
+    day = _dates(rnd,'%m/%d/%Y')
+    def rows():
+        for row in xrange(n):
+            yield [day(),str(row),rnd.choice(PAYEES),'Checking','Bank of X - 1234','',
+                   'Groceries','Home',rnd.random()<0.2 and 'note' or '','R',_amount(rnd),'USD']
+    return header, rows(), []
+
+def _gen_citi(mapping, amount_header, fmt):
+    def gen_citi(rnd, n):
+        header = [mapping['_params']['Header_TransactionDate'],'Posting Date','Description',amount_header]
+        day = _dates(rnd,fmt)
+        def rows():
+            for row in xrange(n):
+                d = day()
+                yield [d,d,rnd.choice(PAYEES),_amount(rnd)]
+        return header, rows(), [['total','','','']]
+    return gen_citi
+
+# the generator for each mapping of all_mappings, by name
+GENERATORS = dict([(name, generator) for name, mapping in mappings.all_mappings.items()
+                   for m, generator in (
+                       (mappings.yodlee, gen_yodlee),
+                       (mappings.cu, gen_cu),
+                       (mappings.ubs, gen_ubs),
+                       (mappings.msmoneyrep, gen_msmoney),
+                       (mappings.CitiMC_English, _gen_citi(mappings.CitiMC_English,'Amount','%m/%d/%Y')),
+                       (mappings.CitiMC_French, _gen_citi(mappings.CitiMC_French,'Montant','%d/%m/%Y')))
+                   if m is mapping])
+
+
+def statement_path(data_dir, name, n):
+    """
+        The synthetic statement of n rows for mapping name, generated in
+        data_dir if it is not there yet.
+    """
+    slug = ''.join([c.isalnum() and c.lower() or '-' for c in name.decode('latin-1').encode('ascii','replace')])
+    path = os.path.join(data_dir, '%s-%d.csv' % (slug, n))
+    if not os.path.isfile(path):
+        header, rows, footer = GENERATORS[name](random.Random(n), n)
+        tmp = path + '.tmp'
+        f = open(tmp,'wb')
+        try:
+            writer = csv.writer(f, delimiter=mappings.all_mappings[name]['_params'].get('delimiter',','))
+            writer.writerow(header)
+            writer.writerows(rows)
+            writer.writerows(footer)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    return path
+
+
+def map_rows(mapping, format, grid):
+    """
+        Evaluates the fields of the format mapping for the rows of grid
+        like the exporter does, without writing anything.
+    """
+    if format == 'OFX':
+        skip = compile_field(mapping['skip'],grid)
+        fields = compile_mapping(mapping,ofx.FIELDS,grid)
+        for rows in grid.iterblocks():
+            fields([row for row, skipped in zip(rows,skip(rows)) if not skipped])
+    else:
+        split = compile_field(mapping['split'],grid)
+        fields = compile_mapping(mapping,qif.FIELDS,grid)
+        split_fields = compile_mapping(mapping,qif.SPLIT_FIELDS,grid)
+        for rows in grid.iterblocks():
+            is_split = split(rows)
+            fields([row for row, s in zip(rows,is_split) if not s])
+            split_fields([row for row, s in zip(rows,is_split) if s])
+
+def peak_memory():
+    """
+        The peak resident memory of this process in MB, None if unknown.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes instead of KB
+        peak /= 1024
+    return peak/1024.0
+
+def run_case(case):
+    """
+        Measures one (name, format, path, storage, export_options) case.
+        Returns [(stage, seconds)], the peak MB of the case and the error
+        if a stage failed.
+    """
+    name, format, path, storage, export_options = case
+    mapping = mappings.all_mappings[name]
+    results = []
+    try:
+        start = time.time()
+        grid = batch.open_table(path, mapping, storage)
+        results.append(('load', time.time()-start))
+
+        start = time.time()
+        map_rows(mapping[format], format, grid)
+        results.append(('map', time.time()-start))
+
+        maptype = mapping['_params'].get('maptype','bank')
+        stdout, sys.stdout = sys.stdout, open(os.devnull,'w')
+        try:
+            start = time.time()
+            batch.EXPORTERS[format](os.devnull, mapping[format], maptype, grid, **export_options)
+            results.append(('write', time.time()-start))
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+    except:
+        return results, peak_memory(), format_exc().strip().splitlines()[-1]
+    return results, peak_memory(), None
+
+
+def _run_child(case, conn):
+    conn.send(run_case(case))
+    conn.close()
+
+def run_process(case):
+    """
+        run_case in a new process, for its own peak memory.  Not a Pool
+        worker since those can't start the --row-jobs processes.
+    """
+    conn, child_conn = Pipe(False)
+    child = Process(target=_run_child, args=(case, child_conn))
+    child.start()
+    try:
+        return conn.recv()
+    finally:
+        child.join()
+
+
+def startup_time(name, format, path, runs=10):
+    """
+        The shortest of runs wall times of converting path with the
+        mapping name in a new python process, from starting python to the
+        written file.
+    """
+    env = dict(os.environ)
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([package_dir] + filter(None, [env.get('PYTHONPATH')]))
+    out_dir = tempfile.mkdtemp()
+    devnull = open(os.devnull,'w')
+    try:
+        best = None
+        for run in xrange(runs):
+            start = time.time()
+            subprocess.check_call([sys.executable, '-c', BATCH_SCRIPT, '-m', name, '-f', format,
+                                   '-o', out_dir, path], env=env, stdout=devnull, stderr=devnull)
+            seconds = time.time()-start
+            if best is None or seconds < best:
+                best = seconds
+        return best
+    finally:
+        devnull.close()
+        shutil.rmtree(out_dir)
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-r", "--rows", default=','.join(map(str,ROWS)),
+                      help="statement sizes, comma separated [default: %default]")
+    parser.add_option("-m", "--mapping", action="append",
+                      help="benchmark the mappings whose name starts with MAPPING, "
+                           "may be repeated [default: all]")
+    parser.add_option("-f", "--format", action="append", choices=batch.EXPORTERS.keys(),
+                      help="OFX or QIF, may be repeated [default: both]")
+    parser.add_option("-S", "--storage", default="rows", choices=batch.TABLES.keys(),
+                      help="how the rows are held, see csv2ofx-batch [default: %default]")
+    parser.add_option("-J", "--row-jobs", type="int", default=1,
+                      help="map the rows with ROW_JOBS processes when writing [default: %default]")
+    parser.add_option("-t", "--startup", action="store_true",
+                      help="measure the time to the first conversion of a small statement, "
+                           "target %dms" % (STARTUP_TARGET*1000))
+    parser.add_option("-d", "--data", metavar="DIR",
+                      default=os.path.join(tempfile.gettempdir(),'csv2ofx-bench'),
+                      help="where the generated statements are kept [default: %default]")
+    options, args = parser.parse_args(argv)
+
+    sizes = [int(n) for n in options.rows.split(',')]
+    names = sorted(GENERATORS)
+    if options.mapping:
+        names = [name for name in names if [m for m in options.mapping if name.startswith(m)]]
+    formats = options.format or sorted(batch.EXPORTERS)
+    if not os.path.isdir(options.data):
+        os.makedirs(options.data)
+
+    if options.startup:
+        print "%-28s %-4s %9s %9s" % ('mapping','fmt','ms','target')
+        slow = 0
+        for name in names:
+            path = statement_path(options.data, name, STARTUP_ROWS)
+            label = name.decode('latin-1').encode('ascii','replace')[:28]
+            for format in formats:
+                try:
+                    seconds = startup_time(name, format, path)
+                except subprocess.CalledProcessError, e:
+                    print "%-28s %-4s failed: exit status %d" % (label, format, e.returncode)
+                    continue
+                slow += seconds > STARTUP_TARGET
+                print "%-28s %-4s %9.1f %9s" % (label, format, seconds*1000,
+                                                seconds > STARTUP_TARGET and 'slow' or 'ok')
+        return slow and 1 or 0
+
+    print "%-28s %-4s %9s %-6s %9s %12s %9s" % ('mapping','fmt','rows','stage','seconds','rows/s','peak MB')
+    for name in names:
+        for n in sizes:
+            path = statement_path(options.data, name, n)
+            for format in formats:
+                results, peak, error = run_process(
+                    (name, format, path, options.storage, {'jobs':options.row_jobs}))
+                label = name.decode('latin-1').encode('ascii','replace')[:28]
+                for stage, seconds in results:
+                    print "%-28s %-4s %9d %-6s %9.2f %12.0f %9s" % (label, format, n, stage, seconds,
+                        n/max(seconds,1e-6), '')
+                if error:
+                    print "%-28s %-4s %9d failed: %s" % (label, format, n, error)
+                else:
+                    # the peak of the whole case, see run_case
+                    total = sum([seconds for stage, seconds in results])
+                    print "%-28s %-4s %9d %-6s %9.2f %12.0f %9s" % (label, format, n, 'total', total,
+                        n/max(total,1e-6), peak is None and '-' or '%.1f' % peak)
+                sys.stdout.flush()
+    return 0
@@ -0,0 +1,171 @@
+
+"""
+    Columnar storage for the csv data.
+
+    CSVTable keeps every cell as its own string in a list per row, which
+    costs far more memory than the text itself.  ColumnarCSVTable keeps
+    each column either as one string holding all the values plus an
+    array of offsets (PackedColumn), or, for columns with few distinct
+    values such as a currency or an account name, as the distinct values
+    plus an array of small codes (InternedColumn).
+"""
+
+from array import array
+from cStringIO import StringIO
+from itertools import islice
+import csv
+
+from csvutils import CSVTable, read_rows
+
+# a column with more distinct values than this is packed instead of interned
+INTERN_LIMIT = 1024
+
+# rows read before they are added to the columns
+LOAD_BLOCK = 1<<14
+
+
+class PackedColumn(object):
+    """
+        The values of a column in one string, value i is
+        data[offsets[i]:offsets[i+1]].
+    """
+    def __init__(self):
+        self.buf = StringIO()
+        self.offsets = array('I',[0])
+        self.data = None
+
+    def extend(self,values):
+        text = ''.join(values)
+        self.buf.write(text)
+        offsets = self.offsets
+        pos = offsets[-1]
+        if offsets.typecode == 'I' and pos+len(text) > 0xffffffff:
+            # more than 4GB in this column
+            offsets = self.offsets = array('L',offsets)
+        append = offsets.append
+        for value in values:
+            pos += len(value)
+            append(pos)
+        # like InternedColumn.extend, but the values always fit
+        return True
+
+    def finish(self):
+        self.data = self.buf.getvalue()
+        self.buf = None
+        return self
+
+    def truncate(self,rows):
+        del self.offsets[rows+1:]
+
+    def get(self,row):
+        offsets = self.offsets
+        return self.data[offsets[row]:offsets[row+1]]
+
+    def values(self,rows):
+        data, offsets = self.data, self.offsets
+        return [data[offsets[row]:offsets[row+1]] for row in rows]
+
+
+class InternedColumn(object):
+    """
+        The values of a column with few distinct values, value i is
+        distinct[codes[i]].
+    """
+    def __init__(self):
+        self.distinct = []
+        self.index = {}
+        self.codes = array('H')
+
+    def extend(self,values):
+        """
+            Returns False, without adding values, if the column would
+            have too many distinct values to be interned.
+        """
+        index = self.index
+        new = set(values).difference(index)
+        if len(self.distinct)+len(new) > INTERN_LIMIT:
+            return False
+        for value in new:
+            index[value] = len(self.distinct)
+            self.distinct.append(value)
+        self.codes.extend(map(index.__getitem__,values))
+        return True
+
+    def finish(self):
+        self.index = None
+        return self
+
+    def packed(self):
+        """
+            The values so far as a PackedColumn.
+        """
+        column = PackedColumn()
+        column.extend(self.values(xrange(len(self.codes))))
+        return column
+
+    def truncate(self,rows):
+        del self.codes[rows:]
+
+    def get(self,row):
+        return self.distinct[self.codes[row]]
+
+    def values(self,rows):
+        distinct, codes = self.distinct, self.codes
+        return [distinct[codes[row]] for row in rows]
+
+
+class ColumnarCSVTable(CSVTable):
+    """
+        A CSVTable that stores the csv data by column.
+
+        Same interface as CSVTable.  Rows shorter than the header read as
+        empty strings for the missing columns, extra fields are dropped.
+    """
+    def _load(self,csv_path,delimiter,skip_last):
+        csv_file = open(csv_path,'r')
+        try:
+            csv_reader = csv.reader(csv_file,delimiter=delimiter,quotechar='"')
+            for header in csv_reader:
+                if len(header)>0: break
+            self.header = header
+            self.grid_cols = cols = len(header)
+
+            columns = [InternedColumn() for c in header]
+            rows = 0
+            if self.since is not None or self.until is not None:
+                # the last skip_last rows are held back before the dates
+                # are checked, see CSVTable.WindowRows
+                csv_reader = self.WindowRows(header,read_rows(csv_file,delimiter,skip_last))
+                skip_last = 0
+            while True:
+                block = list(islice(csv_reader,LOAD_BLOCK))
+                if not block: break
+                block = [row for row in block if len(row)>0]
+                for i, row in enumerate(block):
+                    if len(row) != cols:
+                        block[i] = (row + ['']*cols)[:cols]
+                for c, values in enumerate(zip(*block)):
+                    if not columns[c].extend(values):
+                        columns[c] = columns[c].packed()
+                        columns[c].extend(values)
+                rows += len(block)
+        finally:
+            csv_file.close()
+
+        rows = max(rows-skip_last,0)
+        for column in columns:
+            column.truncate(rows)
+        self.columns = [column.finish() for column in columns]
+        self.grid_rows = rows+1
+
+    def IsEmptyCell(self,row,col):
+        return len(self.columns[col].get(row)) == 0
+
+    def GetValue(self,row,col):
+        return self.columns[col].get(row)
+
+    def GetColumn(self,col,rows):
+        return self.columns[col].values(rows)
+
+    def GetColLabelValue(self,col):
+        return self.header[col]
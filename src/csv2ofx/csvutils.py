@@ -1,65 +1,232 @@
 
 
 from datetime import datetime
+from collections import deque
+from bisect import bisect_left, bisect_right
+from itertools import islice, chain, ifilter
+from tempfile import SpooledTemporaryFile
+from shutil import copyfileobj
 import csv
+import re
 
-from wx.grid import PyGridTableBase
+import timing
+from dates import date_parser, detect_format, SAMPLE_SIZE
+from amounts import to_cents
 
+# bytes of exported text an account buffer keeps in memory before it spills to disk
+SPILL_SIZE = 1<<20
+# rows the mapping is evaluated for at a time, see iterblocks
+BLOCK_SIZE = 1024
+# distinct date strings remembered by DateStrToDatetime
+DATE_CACHE_SIZE = 1<<16
 
-class SimpleCSVGrid(PyGridTableBase):
+
+def read_rows(csv_file,delimiter=',',skip_last=0):
     """
-        A very basic instance that allows the csv contents to be used
-        in a wx.Grid
+        Generates the rows of the open csv_file, the header row first.
+        Empty rows are left out and the last skip_last rows are held back.
     """
-    def __init__(self,csv_path,mapping,delimiter=',',skip_last=0):
-        PyGridTableBase.__init__(self)
-        # delimiter, quote could come from config file perhaps
-        csv_reader = csv.reader(open(csv_path,'r'),delimiter=delimiter,quotechar='"')
-        self.grid_contents = [row for row in csv_reader if len(row)>0]
-        if skip_last:
-            self.grid_contents=self.grid_contents[:-skip_last]
-        
-        # the 1st row is the column headers
-        self.grid_cols = len(self.grid_contents[0])
-        self.grid_rows = len(self.grid_contents)
+    # delimiter, quote could come from config file perhaps
+    held = deque()
+    for row in csv.reader(csv_file,delimiter=delimiter,quotechar='"'):
+        if len(row)==0: continue
+        held.append(row)
+        if len(held)>skip_last:
+            yield held.popleft()
+
+
+class CSVTable(object):
+    """
+        The csv contents as a data table.
+
+        Implements the same interface as a wx.grid table (GetValue,
+        GetNumberRows, ...) without depending on wx so the exporters can
+        be used headless.  The GUI mixes this class into SimpleCSVGrid.
+
+        since, until: datetimes, only the rows with since <= date <= until
+        are loaded (either may be None for an open range), see WindowRows.
+    """
+    def __init__(self,csv_path,mapping,delimiter=',',skip_last=0,since=None,until=None):
+        self.mapping = mapping
+        self.since = since
+        self.until = until
+        self.date_cache = {}
+        # see DateParser, set when the first date is parsed
+        self.parse_date = None
+
+        timing.stage('load',self._load)(csv_path,delimiter,skip_last)
                 
         # header map
         # results in a dictionary of column labels to numeric column location            
-        self.col_map=dict([(self.grid_contents[0][c],c) for c in range(self.grid_cols)])
+        self.col_map=dict([(self.GetColLabelValue(c),c) for c in range(self.grid_cols)])
         
-        self.mapping = mapping
         self.date_column = self.GetColPos(self.mapping['_params']['Header_TransactionDate'])
+        # parsed lazily by GetDatetime
+        self.row_datetimes = [None]*self.GetNumberRows()
+        # date index, see GetDateRange and GetRowsBetween
+        self.date_order = None
+        self.sorted_datetimes = None
         self.min_datetime = None
         self.max_datetime = None
         self.TransIdPrefix = None
 
-        
+    def _load(self,csv_path,delimiter,skip_last):
+        """
+            Reads the csv file, sets grid_cols and grid_rows (including
+            the header row).
+        """
+        csv_file = open(csv_path,'r')
+        try:
+            rows = read_rows(csv_file,delimiter,skip_last)
+            header = rows.next()
+            self.grid_contents = [header]
+            self.grid_contents.extend(self.WindowRows(header,rows))
+        finally:
+            csv_file.close()
+
+        # the 1st row is the column headers
+        self.grid_cols = len(self.grid_contents[0])
+        self.grid_rows = len(self.grid_contents)
+
+    def GetDateRange(self):
+        """
+            The (min, max) transaction dates, found in one pass over the rows.
+        """
+        if self.min_datetime is None:
+            if self.GetNumberRows():
+                dates = [self.GetDatetime(row) for row in xrange(self.GetNumberRows())]
+                self.min_datetime, self.max_datetime = min(dates), max(dates)
+            else:
+                self.min_datetime, self.max_datetime = datetime.max, datetime.min
+        return self.min_datetime, self.max_datetime
+
+    def GetStatementRange(self):
+        """
+            The (start, end) dates the statement covers: since and until
+            where given, else the first and last transaction dates.
+        """
+        min_datetime, max_datetime = self.GetDateRange()
+        return self.since or min_datetime, self.until or max_datetime
+
+    def WindowRows(self,header,rows):
+        """
+            The rows (lists of cells, after the header row) whose
+            transaction date is within since and until, all of them if
+            neither is given.
+
+            Only the date cell of a row is parsed (DateStrToDatetime,
+            which remembers each date string) to tell, so the rows outside
+            the window cost no mapping at all.
+        """
+        if self.since is None and self.until is None:
+            return rows
+        rows = iter(rows)
+        # an 'auto' DateFormat is detected on the first rows
+        sample = list(islice(rows,SAMPLE_SIZE))
+        return ifilter(self.DateWindow(header,sample),chain(sample,rows))
+
+    def DateWindow(self,header,sample):
+        """
+            A function telling if a row (a list of cells) is within since
+            and until.  sample: the first rows of the file.
+        """
+        col = dict(zip(header,range(len(header))))[self.mapping['_params']['Header_TransactionDate']]
+        if self.parse_date is None:
+            self.parse_date = timing.stage('dates',self.DateParser([row[col] for row in sample]))
+        since, until = self.since or datetime.min, self.until or datetime.max
+        to_datetime = self.DateStrToDatetime
+        return lambda row: since <= to_datetime(row[col]) <= until
+
     def GetMinDate(self):
-        if self.min_datetime == None:
-            self.min_datetime = datetime.max
-            for row in range(self.GetNumberRows()):
-                tmpDatetime = self.GetDatetime(row)
-                if tmpDatetime < self.min_datetime:
-                    self.min_datetime = tmpDatetime
-        return self.min_datetime     
+        return self.GetDateRange()[0]
             
     def GetMaxDate(self):
-        if self.max_datetime == None:
-            self.max_datetime = datetime.min
-            for row in range(self.GetNumberRows()):
-                tmpDatetime = self.GetDatetime(row)
-                if tmpDatetime > self.max_datetime:
-                    self.max_datetime = tmpDatetime
-        return self.max_datetime
+        return self.GetDateRange()[1]
+
+    def GetRowsBetween(self, start=None, end=None):
+        """
+            The rows with start <= date <= end (either may be None for an
+            open range) in date order, rows of the same date in file order.
+
+            The date ordering of the rows is built on the first call.
+        """
+        if self.date_order is None:
+            self.date_order = sorted(xrange(self.GetNumberRows()), key=self.GetDatetime)
+            self.sorted_datetimes = [self.GetDatetime(row) for row in self.date_order]
+        lo, hi = 0, len(self.date_order)
+        if start is not None:
+            lo = bisect_left(self.sorted_datetimes, start)
+        if end is not None:
+            hi = bisect_right(self.sorted_datetimes, end)
+        return self.date_order[lo:hi]
     
+    def DateParser(self,dates=None):
+        """
+            The function parsing the transaction dates: Function_DateStrToDatetime
+            of the mapping, else a parser compiled from its DateFormat (see
+            dates.py), which 'auto' detects on dates, the first rows if None.
+        """
+        params = self.mapping['_params']
+        if 'Function_DateStrToDatetime' in params:
+            return params['Function_DateStrToDatetime']
+        format = params['DateFormat']
+        if format == 'auto':
+            if dates is None:
+                dates = self.SampleDates()
+            format = detect_format(dates)
+        return date_parser(format)
+
+    def SampleDates(self,size=SAMPLE_SIZE):
+        """
+            The date strings of the first size rows.
+        """
+        return self.GetColumn(self.date_column,xrange(min(size,self.GetNumberRows())))
+
+    def DateStrToDatetime(self, date):
+        """
+            The date string parsed by DateParser, remembering the result
+            for each date string since statements repeat the same few dates.
+        """
+        try:
+            return self.date_cache[date]
+        except KeyError:
+            if len(self.date_cache) >= DATE_CACHE_SIZE:
+                self.date_cache.clear()
+            if self.parse_date is None:
+                # the rows are loaded by now, even in the GUI
+                self.parse_date = timing.stage('dates',self.DateParser())
+            tmpDatetime = self.date_cache[date] = self.parse_date(date)
+            return tmpDatetime
+
     def GetDatetime(self, row):
-        return self.mapping['_params']['Function_DateStrToDatetime'](self.GetValue(row, self.date_column))
+        tmpDatetime = self.row_datetimes[row]
+        if tmpDatetime is None:
+            tmpDatetime = self.row_datetimes[row] = self.DateStrToDatetime(self.GetValue(row, self.date_column))
+        return tmpDatetime
         
     def GenerateTransactionId(self, row):
         if self.TransIdPrefix == None:
             self.TransIdPrefix = self.GetMinDate().strftime('%Y%m%d') + ':' + self.GetMaxDate().strftime('%Y%m%d')           
         return self.TransIdPrefix  + ':' + str(row)
             
+    def iterrows(self):
+        """
+            The row numbers the exporters walk through.
+        """
+        return xrange(self.GetNumberRows())
+
+    def iterblocks(self,size=BLOCK_SIZE,start=0,stop=None):
+        """
+            The row numbers the exporters walk through in blocks of
+            up to size rows, for evaluating the mapping a column at a time.
+
+            start, stop: only the rows start to stop-1
+        """
+        if stop is None:
+            stop = self.GetNumberRows()
+        for first in xrange(start,stop,size):
+            yield xrange(first,min(first+size,stop))
+
     def GetNumberRows(self):
         return self.grid_rows-1
     
@@ -71,30 +238,208 @@ class SimpleCSVGrid(PyGridTableBase):
     
     def GetValue(self,row,col):
         return self.grid_contents[row+1][col]
+
+    def GetColumn(self,col,rows):
+        """
+            The values of column col for the row numbers rows.
+        """
+        contents = self.grid_contents
+        return [contents[row+1][col] for row in rows]
     
     def GetColLabelValue(self,col):
         return self.grid_contents[0][col]
     
     def GetColPos(self,col_name):
         return self.col_map[col_name]
+
+
+class CSVStream(CSVTable):
+    """
+        A CSVTable that reads the csv file one row at a time.
+
+        Only the current block of rows is held in memory so the exporters
+        can convert files of any size.  Rows must be visited in order with
+        iterblocks() or iterrows(); GetValue only answers for the rows of
+        the current block.
+
+        The min/max dates are collected while the rows stream through.  If
+        they are needed before the stream has been read to the end (e.g.
+        GenerateTransactionId) the date column is scanned once up front.
+    """
+    def _load(self,csv_path,delimiter,skip_last):
+        self.csv_path = csv_path
+        self.delimiter = delimiter
+        self.skip_last = skip_last
+
+        csv_file = open(csv_path,'r')
+        try:
+            for header in csv.reader(csv_file,delimiter=delimiter,quotechar='"'):
+                if len(header)>0: break
+        finally:
+            csv_file.close()
+
+        self.header = header
+        self.grid_cols = len(header)
+
+        self.rows_read = 0
+        # the block of rows iterblocks is on
+        self.window = []
+        self.window_start = 0
+        self.window_datetimes = []
+
+    def _rows(self):
+        """
+            Generates the data rows, holding back the skip_last rows.
+        """
+        csv_file = open(self.csv_path,'r')
+        try:
+            rows = read_rows(csv_file,self.delimiter,self.skip_last)
+            # after the header
+            for row in self.WindowRows(rows.next(),rows):
+                yield row
+        finally:
+            csv_file.close()
+
+    def SampleDates(self,size=SAMPLE_SIZE):
+        return [row[self.date_column] for row in islice(self._rows(),size)]
+
+    def _scan_dates(self):
+        min_datetime, max_datetime = datetime.max, datetime.min
+        for row in self._rows():
+            tmpDatetime = self.DateStrToDatetime(row[self.date_column])
+            if tmpDatetime < min_datetime:
+                min_datetime = tmpDatetime
+            if tmpDatetime > max_datetime:
+                max_datetime = tmpDatetime
+        self.min_datetime, self.max_datetime = min_datetime, max_datetime
+
+    def iterblocks(self,size=BLOCK_SIZE):
+        min_datetime, max_datetime = datetime.max, datetime.min
+        rows = self._rows()
+        start = 0
+        while True:
+            window = list(islice(rows,size))
+            if not window: break
+            self.window, self.window_start = window, start
+            self.window_datetimes = [None]*len(window)
+            block = xrange(start,start+len(window))
+            for row in block:
+                tmpDatetime = self.GetDatetime(row)
+                if tmpDatetime < min_datetime:
+                    min_datetime = tmpDatetime
+                if tmpDatetime > max_datetime:
+                    max_datetime = tmpDatetime
+            yield block
+            start += len(window)
+        self.rows_read = start
+        self.window, self.window_datetimes = [], []
+        self.min_datetime, self.max_datetime = min_datetime, max_datetime
+
+    def iterrows(self):
+        for block in self.iterblocks():
+            for row in block:
+                yield row
+
+    def GetDateRange(self):
+        if self.min_datetime is None:
+            self._scan_dates()
+        return self.min_datetime, self.max_datetime
+
+    def GetRowsBetween(self, start=None, end=None):
+        """
+            Like CSVTable.GetRowsBetween, found in one pass over the date
+            column of the file.  The values of the rows are read in order
+            by iterblocks, e.g. the rows of each block that are in
+            set(GetRowsBetween(start, end)).
+        """
+        start, end = start or datetime.min, end or datetime.max
+        date_column = self.date_column
+        dated = []
+        for row, cells in enumerate(self._rows()):
+            tmpDatetime = self.DateStrToDatetime(cells[date_column])
+            if start <= tmpDatetime <= end:
+                dated.append((tmpDatetime, row))
+        # in date order, rows of the same date in file order
+        dated.sort()
+        return [row for tmpDatetime, row in dated]
+
+    def _window_pos(self,row):
+        pos = row-self.window_start
+        if pos < 0 or pos >= len(self.window):
+            raise IndexError("CSVStream only holds rows %s to %s, not row %s" % (
+                self.window_start, self.window_start+len(self.window)-1, row))
+        return pos
+
+    def GetDatetime(self, row):
+        pos = self._window_pos(row)
+        tmpDatetime = self.window_datetimes[pos]
+        if tmpDatetime is None:
+            tmpDatetime = self.window_datetimes[pos] = self.DateStrToDatetime(self.window[pos][self.date_column])
+        return tmpDatetime
+
+    def GetNumberRows(self):
+        """
+            The number of rows read, only known once the stream is finished.
+        """
+        return self.rows_read
+
+    def IsEmptyCell(self,row,col):
+        return len(self.GetValue(row,col)) == 0
+
+    def GetValue(self,row,col):
+        return self.window[self._window_pos(row)][col]
+
+    def GetColumn(self,col,rows):
+        window, pos = self.window, self._window_pos
+        return [window[pos(row)][col] for row in rows]
+
+    def GetColLabelValue(self,col):
+        return self.header[col]
     
 
 
+def spill_buffer():
+    """
+        A file like buffer for exported text that is kept in memory
+        until it grows past SPILL_SIZE and then moves to a temporary file.
+    """
+    return SpooledTemporaryFile(SPILL_SIZE)
+
+def copy_buffer(buf,out):
+    """
+        Copies everything written to buf into the file out.
+    """
+    buf.seek(0)
+    copyfileobj(buf,out)
+
+# the characters xmlize replaces and their replacements
+XML_ESCAPES = {'&':'&amp;', '<':'&lt;', '>':'&gt;', '\r\n':' ', '\n':' '}
+_xml_special = re.compile('\r\n|[&<>\n]')
+
+def _xml_escape(match):
+    return XML_ESCAPES[match.group()]
+
 def xmlize(dat):
     """
         Xml data can't contain &,<,>
         replace with &amp; &lt; &gt;
         Get newlines while we're at it.
+
+        Done in one pass, strings without any of those characters
+        and values that aren't strings are returned as they are.
     """
-    return dat.replace('&','&amp;').replace('<','&lt;').replace('>','&gt;').replace('\r\n',' ').replace('\n',' ')
+    if not isinstance(dat,basestring) or _xml_special.search(dat) is None:
+        return dat
+    return _xml_special.sub(_xml_escape,dat)
     
 def fromCSVCol(row,grid,col_name):
     """
         Uses the current row and the name of the column to look up the value from the csv data.
+
+        The value is returned as it is in the csv file, the OFX exporter
+        escapes the mapped values for xml.
     """
-    return xmlize(grid.GetValue(row,grid.GetColPos(col_name)))
+    return grid.GetValue(row,grid.GetColPos(col_name))
     
 def inverseSign(v):
-    f = float(v)
-    inv = f * -1
-    return "%.2f" % inv
+    return str(-to_cents(v))
@@ -0,0 +1,441 @@
+
+"""
+    Declarative mapping fields.
+
+    Most mapping fields only copy a column or combine columns in a simple
+    way.  Instead of a lambda, such a field can be declared with the
+    classes below, e.g.
+
+    'BANKID':Split(CSVCol('Account Name'),' - ',0),
+    'TRNAMT':InverseSign(CSVCol('Amount')),
+    'MEMO':JoinNonEmpty(' / ',CSVCol('Description 1'),CSVCol('Description 2')),
+
+    The exporters evaluate declared fields a column at a time for a block
+    of rows (see compile_mapping) instead of calling a function per cell.
+    A declared field is still callable as f(row,grid), so lambdas and
+    declared fields can be mixed freely in a mapping.
+
+    TransactionHash is a FITID that stays the same when the transaction is
+    exported again from another statement.
+
+    Amount, DebitCredit and InverseSign give the amounts in exact integer
+    cents (amounts.Cents), which the exporters write as decimal amounts.
+
+    Fields whose values can't contain markup characters or line breaks
+    (dates, amounts, ...) are clean and skip the exporter's escaping.
+    CSVCol('Amount',clean=True) declares a column as clean.
+
+    When the OFX and the QIF sections are exported in one pass (see
+    multi.py), the fields they have in common, e.g. Amount(CSVCol('Amount'))
+    in both, are evaluated once through SharedColumns.
+"""
+
+from hashlib import sha1
+from types import FunctionType
+
+from csvutils import xmlize
+from amounts import Cents, parse_cents, to_cents
+import timing
+
+
+def is_clean(value):
+    """
+        True if value needs no escaping.
+    """
+    return xmlize(value) == value
+
+
+class Field(object):
+    """
+        Base class for the declared fields.
+
+        compile(grid) returns a function that takes a sequence of row
+        numbers and returns the list of the field values for those rows.
+
+        clean: the values never need escaping
+        ordered: the values depend on the rows before, so the rows must be
+            evaluated in order in one pass (see parallel.can_split)
+    """
+    clean = False
+    ordered = False
+
+    def __call__(self,row,grid):
+        return self.compile(grid)([row])[0]
+
+    def compile(self,grid):
+        raise NotImplementedError
+
+
+class CSVCol(Field):
+    """
+        The value of one column.
+
+        'PAYEE':CSVCol('Description') is the same as
+        'PAYEE':lambda row,grid: fromCSVCol(row,grid,'Description')
+
+        clean: the column never holds markup characters or line breaks
+    """
+    def __init__(self,col_name,clean=False):
+        self.col_name = col_name
+        self.clean = clean
+
+    def compile(self,grid):
+        pos = grid.GetColPos(self.col_name)
+        return lambda rows: grid.GetColumn(pos,rows)
+
+
+class Const(Field):
+    """
+        The same value for every row, e.g. 'CURDEF':Const('USD')
+    """
+    def __init__(self,value):
+        self.value = value
+        self.clean = is_clean(value)
+
+    def compile(self,grid):
+        return lambda rows: [self.value]*len(rows)
+
+
+class RowNumber(Field):
+    """
+        The row number, e.g. as FITID
+    """
+    clean = True
+
+    def compile(self,grid):
+        return list
+
+
+class TransactionDate(Field):
+    """
+        The transaction date (Header_TransactionDate) in strftime format,
+        e.g. 'DTPOSTED':TransactionDate('%Y%m%d')
+    """
+    def __init__(self,format):
+        self.format = format
+        self.clean = is_clean(format)
+
+    def compile(self,grid):
+        formatted = {}
+        def column(rows):
+            values = []
+            for tmpDatetime in map(grid.GetDatetime,rows):
+                value = formatted.get(tmpDatetime)
+                if value is None:
+                    value = formatted[tmpDatetime] = tmpDatetime.strftime(self.format)
+                values.append(value)
+            return values
+        return column
+
+
+class Replace(Field):
+    """
+        field with old replaced by new, e.g. Replace(CSVCol('Amount'),'$','')
+    """
+    def __init__(self,field,old,new):
+        self.field, self.old, self.new = field, old, new
+        self.clean = getattr(field,'clean',False) and is_clean(new)
+
+    def compile(self,grid):
+        column = compile_field(self.field,grid)
+        old, new = self.old, self.new
+        return lambda rows: [value.replace(old,new) for value in column(rows)]
+
+
+class Split(Field):
+    """
+        Item index of field split on sep, e.g. Split(CSVCol('Account Name'),' - ',-1)
+    """
+    def __init__(self,field,sep,index):
+        self.field, self.sep, self.index = field, sep, index
+        self.clean = getattr(field,'clean',False)
+
+    def compile(self,grid):
+        column = compile_field(self.field,grid)
+        sep, index = self.sep, self.index
+        return lambda rows: [value.split(sep)[index] for value in column(rows)]
+
+
+class Amount(Field):
+    """
+        The amount in field as Cents (see amounts.py), parsed with the
+        decimal point decimal, e.g. Amount(CSVCol('Montant'),decimal=',').
+        Empty cells are 0.
+    """
+    clean = True
+
+    def __init__(self,field,decimal='.'):
+        self.field, self.decimal = field, decimal
+
+    def compile(self,grid):
+        column = compile_field(self.field,grid)
+        decimal, zero = self.decimal, Cents(0)
+        def cents(rows):
+            values = column(rows)
+            try:
+                return [value and parse_cents(value,decimal) or zero for value in values]
+            except AttributeError:
+                # not strings, e.g. the Cents of another field
+                return [value and to_cents(value) or zero for value in values]
+        return cents
+
+
+class DebitCredit(Field):
+    """
+        The amount of statements with separate debit and credit columns,
+        credit - debit in Cents, e.g. DebitCredit(CSVCol('Debit'),CSVCol('Credit'))
+    """
+    clean = True
+
+    def __init__(self,debit,credit,decimal='.'):
+        self.debit, self.credit = Amount(debit,decimal), Amount(credit,decimal)
+
+    def compile(self,grid):
+        debit, credit = self.debit.compile(grid), self.credit.compile(grid)
+        return lambda rows: [c - d for d, c in zip(debit(rows),credit(rows))]
+
+
+class InverseSign(Field):
+    """
+        The amount in field as Cents with the sign inverted
+    """
+    clean = True
+
+    def __init__(self,field):
+        self.field = field
+
+    def compile(self,grid):
+        column = compile_field(self.field,grid)
+        return lambda rows: [-to_cents(value) for value in column(rows)]
+
+
+class Join(Field):
+    """
+        The fields joined with sep, e.g. Join('-',CSVCol('Category'),CSVCol('Class'))
+    """
+    def __init__(self,sep,*fields):
+        self.sep, self.fields = sep, fields
+        self.clean = is_clean(sep) and all([getattr(f,'clean',False) for f in fields])
+
+    def _join(self,values):
+        return self.sep.join(values)
+
+    def compile(self,grid):
+        columns = [compile_field(field,grid) for field in self.fields]
+        join = self._join
+        return lambda rows: map(join,zip(*[column(rows) for column in columns]))
+
+
+class JoinNonEmpty(Join):
+    """
+        Like Join but leaves out the empty fields.
+    """
+    def _join(self,values):
+        return self.sep.join(filter(None,values))
+
+
+class Equals(Field):
+    """
+        True where field equals value, e.g. 'skip':Equals(CSVCol('Split Type'),'Split')
+    """
+    clean = True
+
+    def __init__(self,field,value):
+        self.field, self.value = field, value
+
+    def compile(self,grid):
+        column = compile_field(self.field,grid)
+        value = self.value
+        return lambda rows: [v == value for v in column(rows)]
+
+
+def normal_amount(amount):
+    """
+        amount written the same way however the csv file writes it,
+        e.g. ' +1234.5' and '1234.50' are both '1234.50'
+    """
+    if isinstance(amount,Cents):
+        return str(amount)
+    amount = amount.strip()
+    try:
+        return '%.2f' % float(amount)
+    except ValueError:
+        return amount
+
+def normal_payee(payee):
+    """
+        payee in upper case with single spaces
+    """
+    return ' '.join(payee.split()).upper()
+
+
+class TransactionHash(Field):
+    """
+        A FITID that stays the same when the transaction is in another
+        statement, unlike the row number or GenerateTransactionId, which
+        depend on the rows and dates around it.  It hashes the transaction
+        date, amount and payee (written in a normal way),
+        e.g. 'FITID':TransactionHash(CSVCol('Amount'),CSVCol('Description'))
+
+        Identical transactions of a file are told apart by counting them
+        in row order, so the rows are evaluated in order in one pass.
+        Calling the field for a single row always counts it as the first.
+    """
+    clean = True
+    ordered = True
+
+    def __init__(self,amount,payee):
+        self.amount, self.payee = amount, payee
+
+    def compile(self,grid):
+        amounts = compile_field(self.amount,grid)
+        payees = compile_field(self.payee,grid)
+        dates = {}
+        # how often each transaction was seen
+        seen = {}
+        def column(rows):
+            values = []
+            for tmpDatetime, amount, payee in zip(map(grid.GetDatetime,rows),amounts(rows),payees(rows)):
+                date = dates.get(tmpDatetime)
+                if date is None:
+                    date = dates[tmpDatetime] = tmpDatetime.strftime('%Y%m%d')
+                key = sha1('%s|%s|%s' % (date,normal_amount(amount),normal_payee(payee)))
+                count = seen.get(key.digest(),0)
+                seen[key.digest()] = count+1
+                key.update('|%d' % count)
+                values.append(key.hexdigest())
+            return values
+        return column
+
+
+def field_key(field):
+    """
+        A key that is the same for fields computing the same values:
+        declared fields of the same class with the same arguments, and
+        functions with the same code and globals and no closure (e.g. the
+        same lambda written in two sections).  Anything else is only the
+        same as itself.
+    """
+    if isinstance(field,Field):
+        return (field.__class__,) + tuple([(name,field_key(value)) for name, value in sorted(vars(field).items())])
+    if isinstance(field,FunctionType):
+        if field.func_closure is not None:
+            return ('id',id(field))
+        code = field.func_code
+        return (code.co_code,code.co_consts,code.co_names,field_key(field.func_defaults),id(field.func_globals))
+    if isinstance(field,(list,tuple)):
+        return tuple(map(field_key,field))
+    try:
+        hash(field)
+    except TypeError:
+        return ('id',id(field))
+    # 1 and True are the same key, but not the same value
+    return (type(field),field)
+
+def _remembered(column):
+    """
+        column, returning the values of the last call again when it is
+        called for the same rows.
+    """
+    last = [None,None]
+    def remembered(rows):
+        last_rows, values = last
+        if rows is not last_rows and rows != last_rows:
+            values = column(rows)
+            last[:] = [rows,values]
+        return values
+    return remembered
+
+class SharedColumns(object):
+    """
+        Compiles the fields of mapping sections exported together for
+        grid, fields with the same field_key once.  Such a column called
+        for the same rows as on its last call, as each section calls it
+        for a block, returns the values it computed then.
+
+        Ordered fields (TransactionHash) are compiled for every use since
+        they count each row they see.
+    """
+    def __init__(self,grid):
+        self.grid = grid
+        self.columns = {}
+
+    def compile(self,field):
+        if getattr(field,'ordered',False):
+            return compile_field(field,self.grid)
+        key = field_key(field)
+        column = self.columns.get(key)
+        if column is None:
+            column = self.columns[key] = _remembered(compile_field(field,self.grid))
+        return column
+
+
+def row_positional(field):
+    """
+        True if field (a FITID) is the row number or GenerateTransactionId,
+        ids that another statement of the same account gives to other
+        transactions.
+    """
+    if isinstance(field,RowNumber):
+        return True
+    code = getattr(field,'func_code',None)
+    return code is not None and 'GenerateTransactionId' in code.co_names
+
+def state_key(mapping,amount,payee):
+    """
+        The field identifying the transactions of a mapping section for an
+        incremental conversion (see state.py): its FITID, or the
+        TransactionHash of the amount and payee fields (named by amount
+        and payee) if it has none or it is row_positional.
+    """
+    fitid = mapping.get('FITID')
+    if fitid is None or row_positional(fitid):
+        return TransactionHash(mapping[amount],mapping[payee])
+    return fitid
+
+
+def compile_field(field,grid,shared=None):
+    """
+        Compiles one mapping field for grid.
+
+        Returns a function that takes a sequence of row numbers and returns
+        the list of field values.  Declared fields are evaluated a column
+        at a time, any other callable f(row,grid) is called for each row.
+
+        shared: SharedColumns the field is compiled with
+    """
+    if shared is not None:
+        return shared.compile(field)
+    if isinstance(field,Field):
+        return field.compile(grid)
+    return lambda rows: [field(row,grid) for row in rows]
+
+def _escaped(column,escape,clean):
+    if clean:
+        return column
+    escape_values = timing.stage('escape',lambda values: map(escape,values))
+    return lambda rows: escape_values(column(rows))
+
+def compile_mapping(mapping,keys,grid,escape=None,label=None,shared=None):
+    """
+        Compiles the fields keys of mapping for grid.
+
+        Returns a function f(rows) that returns a list with the tuple of
+        the field values (in the order of keys) for each row in rows.
+        Every field is evaluated once per row.
+
+        escape: applied to the values of the fields that aren't clean
+        label: the fields are timed as label.key if the timing is on,
+            see timing.py
+        shared: SharedColumns the fields are compiled with
+    """
+    columns = [compile_field(mapping[key],grid,shared) for key in keys]
+    if label is not None:
+        columns = [timing.field('%s.%s' % (label,key),mapping[key],column)
+                   for key, column in zip(keys,columns)]
+    if escape is not None:
+        columns = [_escaped(column,escape,getattr(mapping[key],'clean',False))
+                   for key, column in zip(keys,columns)]
+    def extract(rows):
+        return zip(*[column(rows) for column in columns])
+    return extract
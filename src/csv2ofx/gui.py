@@ -0,0 +1,511 @@
+import sys, os, time
+import threading
+from traceback import print_exc, format_exc
+
+from array import array
+from itertools import islice
+
+import wx
+from wx import xrc
+import wx.grid as grd
+
+from csvutils import *
+from mapped import MappedCSVTable, index_blocks
+from registry import load_mappings, detect_mapping, MappingError
+import ofx, qif, multi
+
+
+# rows a load task reads before they are added to the grid
+LOAD_BLOCK = 1<<12
+
+# steps of the progress gauge
+GAUGE_RANGE = 1000
+
+
+class Cancelled(Exception):
+    """
+        Raised in a worker thread when its Task was cancelled.
+    """
+
+
+class Task(threading.Thread):
+    """
+        Runs work(task) in a worker thread.
+
+        The work reports its progress with Progress(fraction), which raises
+        Cancelled once Cancel() was called.  The gui is only touched in the
+        main thread, through wx.CallAfter: on_progress(fraction) as the work
+        goes, then on_done(result) or on_failed(error), where error is the
+        formatted exception or None if the task was cancelled.
+    """
+    def __init__(self,work,on_progress,on_done,on_failed):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.work = work
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.on_failed = on_failed
+        self.cancelled = threading.Event()
+
+    def Cancel(self):
+        self.cancelled.set()
+
+    def Progress(self,fraction):
+        if self.cancelled.isSet():
+            raise Cancelled()
+        wx.CallAfter(self.on_progress,fraction)
+
+    def run(self):
+        try:
+            result = self.work(self)
+        except Cancelled:
+            wx.CallAfter(self.on_failed,None)
+        except:
+            wx.CallAfter(self.on_failed,format_exc())
+        else:
+            wx.CallAfter(self.on_done,result)
+
+
+class BackgroundGrid(object):
+    """
+        A wx.Grid table that is loaded and exported by a Task.
+
+        The table is created with the header row only.  The load task
+        reads the rows with ReadBlocks() and the main thread adds each
+        block with AddRows(), so the grid fills in as the file is read.
+        While progress is set (to Task.Progress) iterblocks reports how far
+        an export is.
+    """
+    progress = None
+
+    def AddRows(self,block):
+        """
+            Appends a block from ReadBlocks and tells the grid.
+        """
+        rows = self.GetNumberRows()
+        self._append(block)
+        added = self.GetNumberRows()-rows
+        self.row_datetimes.extend([None]*added)
+        view = self.GetView()
+        if added and view is not None:
+            view.ProcessTableMessage(
+                grd.GridTableMessage(self,grd.GRIDTABLE_NOTIFY_ROWS_APPENDED,added))
+
+    def iterblocks(self,size=BLOCK_SIZE,start=0,stop=None):
+        if stop is None:
+            stop = self.GetNumberRows()
+        for block in super(BackgroundGrid,self).iterblocks(size,start,stop):
+            if self.progress is not None:
+                self.progress(float(block[-1]-start+1)/max(stop-start,1))
+            yield block
+
+
+class SimpleCSVGrid(BackgroundGrid, CSVTable, grd.PyGridTableBase):
+    """
+        A very basic instance that allows the csv contents to be used
+        in a wx.Grid
+    """
+    def __init__(self,csv_path,mapping,delimiter=',',skip_last=0):
+        grd.PyGridTableBase.__init__(self)
+        CSVTable.__init__(self,csv_path,mapping,delimiter,skip_last)
+
+    def _load(self,csv_path,delimiter,skip_last):
+        self.csv_size = max(os.path.getsize(csv_path),1)
+        self.csv_file = open(csv_path,'r')
+        self.rows = read_rows(self.csv_file,delimiter,skip_last)
+        # the 1st row is the column headers
+        self.grid_contents = [self.rows.next()]
+        self.grid_cols = len(self.grid_contents[0])
+        self.grid_rows = 1
+
+    def ReadBlocks(self):
+        """
+            Generates (rows, fraction of the file read), in the worker thread.
+        """
+        try:
+            while True:
+                block = list(islice(self.rows,LOAD_BLOCK))
+                if not block: break
+                yield block, float(self.csv_file.tell())/self.csv_size
+        finally:
+            self.csv_file.close()
+
+    def _append(self,block):
+        self.grid_contents.extend(block)
+        self.grid_rows += len(block)
+
+
+class MappedCSVGrid(BackgroundGrid, MappedCSVTable, grd.PyGridTableBase):
+    """
+        SimpleCSVGrid for large files, the rows are parsed as the grid
+        shows them (see mapped.py)
+    """
+    def __init__(self,csv_path,mapping,delimiter=',',skip_last=0):
+        grd.PyGridTableBase.__init__(self)
+        MappedCSVTable.__init__(self,csv_path,mapping,delimiter,skip_last)
+
+    def _load(self,csv_path,delimiter,skip_last):
+        self.csv_size = max(os.path.getsize(csv_path),1)
+        self._map(csv_path,delimiter)
+        self.skip_last = skip_last
+        self.starts = array('L')
+        self.grid_rows = 1
+
+    def ReadBlocks(self):
+        """
+            Generates (record offsets, fraction of the file read), in the
+            worker thread.
+        """
+        for block in index_blocks(self.data,self.skip_last):
+            yield block, float(block and block[-1] or 0)/self.csv_size
+
+    def _append(self,block):
+        self.starts.extend(block)
+        self.grid_rows = max(len(self.starts)-1,1)
+        # the last page parsed may be missing rows indexed since
+        self.pages.clear()
+        self.last_page = (None,None)
+
+# files larger than this are opened as a MappedCSVGrid
+MAPPED_SIZE = 16<<20
+
+# the first mapping choice, the mapping is found from the header of the file
+AUTO_MAPPING = "(detect from header)"
+
+
+class csv2ofx(wx.App):
+    """
+        class csv2ofx
+        
+        Extends wx.App
+        
+        Provides a data table to preview csv input.
+    """
+    def __init__(self):
+        wx.App.__init__(self,redirect=False)
+    
+    def OnInit(self):
+        """
+           Initializes and shows frame from csv2ofx.xrc 
+        """
+        
+        # load the xml resource
+        script_dir = os.path.dirname ( __file__ )
+        self.res = xrc.XmlResource ( "%s/csv2ofx.xrc" % script_dir )
+        
+        # load the frame from the resource        
+        self.frame = self.res.LoadFrame ( None, "ID_CSV2OFX")
+        
+        # associate the MenuBar
+        self.frame.SetMenuBar (
+            self.res.LoadMenuBar("ID_MENUBAR")
+        )
+
+        # the grid
+        self.grid = xrc.XRCCTRL(self.frame,"ID_GRID")
+        self.grid.EnableEditing(False)
+        
+        # the mappings
+        self.mappings = xrc.XRCCTRL(self.frame,"ID_MAPPINGS")
+
+        # progress of the import or export running in the background
+        self.gauge = xrc.XRCCTRL(self.frame,"ID_GAUGE")
+        self.gauge.SetRange(GAUGE_RANGE)
+        self.cancel = xrc.XRCCTRL(self.frame,"ID_BTN_CANCEL")
+        self.cancel.Enable(False)
+        self.task = None
+        self.loaded = False
+
+        # custom mappings first, see registry.py
+        self.all_mappings = load_mappings()
+        self.mappings.Append ( AUTO_MAPPING, None )
+        for mapping in self.all_mappings:
+            self.mappings.Append ( mapping, self.all_mappings[mapping] )
+        self.mappings.SetSelection(0)
+        # the mapping the open file was read with
+        self.opened_mapping = None
+
+        # output formats
+        self.exports = xrc.XRCCTRL(self.frame,"ID_EXPORT")
+        
+        # handle events
+        self.Bind ( wx.EVT_MENU, self.OnCloseBtn, id=xrc.XRCID("ID_MENU_CLOSE"))
+        self.Bind ( wx.EVT_BUTTON, self.OnCloseBtn, id=xrc.XRCID("ID_BTN_CLOSE"))
+        self.Bind ( wx.EVT_MENU, self.OnImport, id=xrc.XRCID("ID_MENU_IMPORT"))
+        self.Bind ( wx.EVT_BUTTON, self.OnImport, id=xrc.XRCID("ID_BTN_IMPORT"))
+        self.Bind ( wx.EVT_MENU, self.OnExport, id=xrc.XRCID("ID_MENU_EXPORT"))
+        self.Bind ( wx.EVT_BUTTON, self.OnExport, id=xrc.XRCID("ID_BTN_EXPORT"))
+        self.Bind ( wx.EVT_BUTTON, self.OnCancel, id=xrc.XRCID("ID_BTN_CANCEL"))
+        self.frame.Bind ( wx.EVT_CLOSE, self.OnClose )
+        self.frame.Bind ( wx.EVT_MOVE, self.OnMove )
+        self.frame.Bind ( wx.EVT_SIZE, self.OnSize )
+        
+        
+        # app preferences
+        self.config = wx.Config ( "csv2ofx" )
+
+        x=self.config.ReadInt("screenx",100)
+        y=self.config.ReadInt("screeny",100)
+        w=self.config.ReadInt("screenw",600)
+        h=self.config.ReadInt("screenh",550)
+
+        
+        # show the frame        
+        self.SetTopWindow(self.frame)
+        
+        self.frame.SetPosition( (x,y) )
+        self.frame.SetSize( (w,h) )
+        self.frame.Show()
+        return True
+        
+    def OnCloseBtn(self,evt):
+        """
+            Close the application.
+        """
+        self.frame.Close()
+        
+    def OnClose(self,evt):
+        """
+            Appliction Closing
+        """
+        print "GoodBye"
+        if self.task is not None:
+            self.task.Cancel()
+        self.config.Flush()
+        evt.Skip()
+        
+    def OnMove(self,evt):
+        """
+            Application Screen Position Changed
+        """
+        x,y = evt.GetPosition()
+        self.config.WriteInt("screenx",x)
+        self.config.WriteInt("screeny",y)
+        evt.Skip()
+        
+    def OnSize(self,evt):
+        """
+            Application Size Changed
+        """
+        w,h = evt.GetSize()
+        self.config.WriteInt("screenw",w)
+        self.config.WriteInt("screenh",h)
+        evt.Skip()
+        
+    def OnCancel(self,evt):
+        """
+            Cancel the import or export running in the background.
+        """
+        if self.task is not None:
+            self.task.Cancel()
+
+    def OnProgress(self,fraction):
+        """
+            Progress of the background task, fraction from 0 to 1.
+        """
+        if self.task is not None:
+            self.gauge.SetValue(int(fraction*GAUGE_RANGE))
+
+    def _busy(self):
+        """
+            True, after telling the user, if a background task is running.
+        """
+        if self.task is None:
+            return False
+        wx.MessageDialog(
+            self.frame,
+            "Wait for the import or export to finish, or cancel it.",
+            "Busy",
+            wx.OK|wx.ICON_INFORMATION
+        ).ShowModal()
+        return True
+
+    def _run_task(self,work,on_done):
+        """
+            Runs work(task) in a background Task, showing its progress in
+            the gauge.  on_done(result) is called once it completed.
+        """
+        def done(result):
+            self._end_task()
+            on_done(result)
+        def failed(error):
+            self._end_task()
+            if error is None:
+                print "Cancelled"
+                return
+            print error
+            wx.MessageDialog(
+                self.frame,
+                error,
+                "Failed",
+                wx.OK|wx.ICON_ERROR
+            ).ShowModal()
+        self.task = Task(work,self.OnProgress,done,failed)
+        self.gauge.SetValue(0)
+        self.cancel.Enable(True)
+        self.task.start()
+
+    def _end_task(self):
+        self.task = None
+        self.gauge.SetValue(0)
+        self.cancel.Enable(False)
+
+    def OnImport(self,evt):
+        """
+            Import a csv file.
+        """
+        if self._busy():
+            return
+        
+        # create an open file dialog
+        dlg = wx.FileDialog (
+            self.frame,
+            message="Open CSV File",
+            wildcard="CSV Files (*.csv)|*.csv|All Files (*.*)|*.*",
+            style=wx.OPEN|wx.CHANGE_DIR,            
+        )
+        if dlg.ShowModal() == wx.ID_OK:
+            path=dlg.GetPath()
+            self._open_file(path)
+        dlg.Destroy()
+    
+    
+    def _open_file(self,path):
+        """
+            Opens a csv file and loads it's contents into the data table.
+            The rows are read in the background and show up in the grid
+            as they are read.
+            
+            path: path to the csv file.
+        """
+        
+        print "Open File %s" % path
+
+        # the mapping the header of the file fits, unless one is selected
+        mapping = self.mappings.GetClientData(self.mappings.GetSelection())
+        if mapping is None:
+            try:
+                name = detect_mapping(path,self.all_mappings)
+            except MappingError, e:
+                wx.MessageDialog(
+                    self.frame,
+                    "%s\nSelect the mapping of the file and import it again." % e,
+                    "No mapping found.",
+                    wx.OK|wx.ICON_ERROR
+                ).ShowModal()
+                return
+            print "Detected mapping %s" % name
+            mapping = self.all_mappings[name]
+
+        try:
+            delimiter=mapping['_params']['delimiter']
+        except:
+            delimiter=','
+        try:
+            skip_last=mapping['_params']['skip_last']
+        except:
+            skip_last=0
+        if os.path.getsize(path) > MAPPED_SIZE:
+            grid_class = MappedCSVGrid
+        else:
+            grid_class = SimpleCSVGrid
+        self.grid_table = grid_class(path,mapping,delimiter,skip_last)
+        self.grid.SetTable(self.grid_table)
+        self.opened_path = path
+        self.opened_mapping = mapping
+        self.loaded = False
+
+        table = self.grid_table
+        def load(task):
+            for block, fraction in table.ReadBlocks():
+                task.Progress(fraction)
+                wx.CallAfter(table.AddRows,block)
+        def loaded(result):
+            self.loaded = True
+            print "Loaded %d rows" % table.GetNumberRows()
+        self._run_task(load,loaded)
+        
+    def SelectedMapping(self):
+        """
+            The mapping selected, the one the open file was read with
+            (e.g. the one detected) if AUTO_MAPPING is selected.
+        """
+        mapping = self.mappings.GetClientData(self.mappings.GetSelection())
+        if mapping is None:
+            return self.opened_mapping
+        return mapping
+
+    def OnExport(self,evt):
+        if self._busy():
+            return
+        if not self.loaded:
+            wx.MessageDialog(
+                self.frame,
+                "Use import to load a csv file.",
+                "No CSV File loaded.",
+                wx.OK|wx.ICON_ERROR                
+            ).ShowModal()
+            return
+        
+        format = self.exports.GetStringSelection()
+        # OFX,QIF saves the QIF file next to the OFX file
+        extension = format.split(',')[0].lower()
+        dlg = wx.FileDialog(
+            self.frame,
+            message='Export File',
+            wildcard="QIF Files (*.qif)|*.qif|OFX Files (*.ofx)|*.ofx|All Files (*.*)|*.*", 
+            style=wx.SAVE|wx.CHANGE_DIR,
+	    defaultDir=os.path.dirname(self.opened_path),
+            defaultFile=os.path.basename(self.opened_path).replace('csv',extension) 
+        )
+        dlg.SetFilterIndex( extension=="ofx" and 1 or 0 )
+        path=None
+        try:
+            if dlg.ShowModal() == wx.ID_OK:
+                path=dlg.GetPath()
+            else:
+                return
+        finally:
+            dlg.Destroy();
+
+        try:
+            maptype=self.SelectedMapping()['_params']['maptype']
+        except:
+            maptype='bank'
+            
+        mapping=self.SelectedMapping()
+        grid=self.grid_table
+        
+        if format == 'OFX':
+            csv2ofx_export = ofx.export
+            mapping = mapping[format]
+        elif format == 'QIF':
+            csv2ofx_export = qif.export
+            mapping = mapping[format]
+        elif format == 'OFX,QIF':
+            # both from one pass over the rows with the whole mapping, see multi.py
+            csv2ofx_export = multi.export
+            path = {'OFX':path, 'QIF':os.path.splitext(path)[0] + '.qif'}
+        else:
+            raise Exception ( "Unhandled export format: %s" % format )
+
+        def export(task):
+            grid.progress = task.Progress
+            try:
+                csv2ofx_export(path,mapping,maptype,grid)
+            finally:
+                grid.progress = None
+        def exported(result):
+            if isinstance(path,dict):
+                saved = '\n'.join([path[name] for name in multi.FORMATS])
+            else:
+                saved = path
+            wx.MessageDialog (
+                self.frame,
+                "%s file saved at:\n%s" % ( format, saved ),
+                "Export Complete",
+                wx.OK|wx.ICON_INFORMATION
+            ).ShowModal()
+        self._run_task(export,exported)
+
+
@@ -0,0 +1,202 @@
+
+"""
+    Memory mapped csv files.
+
+    MappedCSVTable maps the csv file into memory and only scans it once
+    for where each row starts.  Rows are parsed when they are asked for,
+    a page of rows at a time, and the last pages used are kept.  Opening
+    a file costs one pass over the bytes and the memory of the row index,
+    so the GUI can show a huge file almost at once: wx.Grid only asks for
+    the visible cells.
+"""
+
+from array import array
+from collections import OrderedDict
+import threading
+import mmap
+import csv
+
+from csvutils import CSVTable, BLOCK_SIZE
+
+# rows parsed together
+PAGE_SIZE = 64
+
+# parsed pages kept, enough for an export block and the visible rows
+PAGE_CACHE_SIZE = 64
+
+# record offsets index_blocks generates at a time
+INDEX_BLOCK = 1<<16
+
+
+def index_blocks(data,skip_last=0,size=INDEX_BLOCK):
+    """
+        Generates arrays of the offsets in data (a str or mmap) where the
+        csv records start, up to size offsets at a time.  The last array
+        ends with where the last record ends, so joined the arrays give
+        the start and the end of each record.
+
+        A line break inside a quoted field does not start a record.  A
+        quote is taken to open or close a quoted field, so quotes inside
+        unquoted fields (a"b) are not supported.  Blank lines are skipped
+        like CSVTable skips empty rows and the last skip_last records are
+        left out.
+    """
+    block = array('L')
+    append = block.append
+    quoted = False
+    pos = 0
+    data.seek(0)
+    for line in iter(data.readline,''):
+        if not quoted and line.strip('\r\n'):
+            append(pos)
+            # the last skip_last records are held back
+            if len(block) >= size+skip_last:
+                yield block[:size]
+                block = block[size:]
+                append = block.append
+        if line.count('"') & 1:
+            quoted = not quoted
+        pos += len(line)
+    if skip_last:
+        # the first record left out ends the last one kept
+        del block[len(block)-skip_last+1:]
+    else:
+        append(pos)
+    yield block
+
+def index_rows(data,skip_last=0):
+    """
+        The offsets in data where the csv records start, plus where the
+        last one ends, see index_blocks.
+    """
+    starts = array('L')
+    for block in index_blocks(data,skip_last):
+        starts.extend(block)
+    return starts
+
+
+class MappedCSVTable(CSVTable):
+    """
+        A CSVTable that parses the rows of a memory mapped csv file on
+        demand.
+
+        Same interface as CSVTable.  close() unmaps the file.  With since
+        or until the rows are the records within the window, found by
+        parsing every record once.  The page cache is locked, so the rows
+        can be read from several threads (the GUI paints the grid while
+        a worker thread exports it).
+    """
+    def _load(self,csv_path,delimiter,skip_last):
+        self._map(csv_path,delimiter)
+        self.starts = index_rows(self.data,skip_last)
+        self.grid_rows = len(self.starts)-1
+        if (self.since is not None or self.until is not None) and self.grid_rows > 1:
+            self.records = self._window_records()
+            self.grid_rows = len(self.records)+1
+
+    def _window_records(self):
+        """
+            The numbers of the records within since and until.
+        """
+        records = array('L')
+        in_window = self.DateWindow(self.header,self._page(0))
+        for page in xrange((self.grid_rows-1+PAGE_SIZE-1)//PAGE_SIZE):
+            first = page*PAGE_SIZE
+            records.extend([first+i for i, row in enumerate(self._page(page)) if in_window(row)])
+        # the pages hold records, not rows
+        self.pages.clear()
+        self.last_page = (None,None)
+        return records
+
+    def _map(self,csv_path,delimiter):
+        """
+            Maps the file and reads the header, the rows are not indexed.
+        """
+        self.delimiter = delimiter
+        csv_file = open(csv_path,'rb')
+        try:
+            self.data = mmap.mmap(csv_file.fileno(),0,access=mmap.ACCESS_READ)
+        finally:
+            # the map stays valid after the file is closed
+            csv_file.close()
+        self.pages = OrderedDict()
+        self.last_page = (None,None)
+        self.pages_lock = threading.Lock()
+        # the record number of each row when only some records are rows
+        self.records = None
+
+        # the 1st row is the column headers
+        for header in csv.reader(iter(self.data.readline,''),delimiter=delimiter,quotechar='"'):
+            if len(header)>0: break
+        self.header = header
+        self.grid_cols = len(header)
+
+    def close(self):
+        self.data.close()
+
+    def _parse(self,start,end):
+        rows = csv.reader(self.data[start:end].splitlines(True),
+                          delimiter=self.delimiter,quotechar='"')
+        return [row for row in rows if len(row)>0]
+
+    def _page(self,page):
+        """
+            The parsed rows of page, the least recently used pages
+            are dropped.
+        """
+        self.pages_lock.acquire()
+        try:
+            last_page, rows = self.last_page
+            if page == last_page:
+                return rows
+            pages = self.pages
+            rows = pages.pop(page,None)
+            if rows is None:
+                # row numbers don't count the header row
+                first = page*PAGE_SIZE+1
+                last = min(first+PAGE_SIZE,len(self.starts)-1)
+                rows = self._parse(self.starts[first],self.starts[last])
+                if len(pages) >= PAGE_CACHE_SIZE:
+                    pages.popitem(last=False)
+            pages[page] = rows
+            self.last_page = (page,rows)
+            return rows
+        finally:
+            self.pages_lock.release()
+
+    def GetDateRange(self):
+        """
+            Like CSVTable.GetDateRange, reading the dates a block at a time.
+        """
+        if self.min_datetime is None and self.GetNumberRows():
+            for rows in self.iterblocks(BLOCK_SIZE):
+                dates = map(self.DateStrToDatetime,self.GetColumn(self.date_column,rows))
+                self.row_datetimes[rows[0]:rows[-1]+1] = dates
+            self.min_datetime = min(self.row_datetimes)
+            self.max_datetime = max(self.row_datetimes)
+        return CSVTable.GetDateRange(self)
+
+    def IsEmptyCell(self,row,col):
+        return len(self.GetValue(row,col)) == 0
+
+    def GetValue(self,row,col):
+        if self.records is not None:
+            row = self.records[row]
+        return self._page(row//PAGE_SIZE)[row%PAGE_SIZE][col]
+
+    def GetColumn(self,col,rows):
+        if self.records is not None:
+            records = self.records
+            rows = [records[row] for row in rows]
+        values = []
+        append = values.append
+        page_number = None
+        for row in rows:
+            if row//PAGE_SIZE != page_number:
+                page_number = row//PAGE_SIZE
+                page = self._page(page_number)
+            append(page[row%PAGE_SIZE][col])
+        return values
+
+    def GetColLabelValue(self,col):
+        return self.header[col]
@@ -21,6 +21,9 @@
 
         returns the csv data for that location
 
+    The values a mapping returns are escaped by the exporters (xml for OFX,
+    line breaks for QIF), a mapping doesn't need to call xmlize.
+
     a mapping is a dictionary of functions.  The exporters call the function for each key
     in the dictionary.  You are free to use any functions or custom logic to return whatever
     data you prefer so that you get the correct data in the fields required by the export format.
@@ -34,11 +37,34 @@
 
     'CHECKNUM':lambda row,grid: fromCSVCol(row,grid,'Check Number')
 
+    Fields that copy or simply combine columns are faster declared with the
+    classes in fields.py (CSVCol, Const, Replace, Split, Join, JoinNonEmpty,
+    InverseSign, Equals, TransactionDate, RowNumber, TransactionHash, Amount, DebitCredit).
+    Those are evaluated a column at a time instead of being called for every row.
+
+    'CHECKNUM':CSVCol('Check Number')
+    'BANKID':Split(CSVCol('Account Name'),' - ',0)
+
+    Columns that only ever hold numbers, dates or codes can be declared clean
+    to skip the escaping:
+
+    'TRNAMT':CSVCol('Amount',clean=True)
+
+    Amounts are best declared with Amount, which parses them once into exact
+    integer cents (leaving out currency symbols, spaces and thousands
+    separators, any other text is an error), or DebitCredit for separate
+    debit and credit columns:
+
+    'TRNAMT':Amount(CSVCol('Montant'),decimal=',')
+    'TRNAMT':DebitCredit(CSVCol('Debit'),CSVCol('Credit'))
+
     Special parameters for import use these keys:
 
         delimiters: [optional] delimiter for CSV, default to ','
         skip_last: [optional] number of lines to skip at the end of the CSV file, default to 0
         Function_DateStrToDatetime: [Mandatory] Function that must convert from the CSV's date format and return a datetime object.
+        DateFormat: [instead of Function_DateStrToDatetime] the strptime format of the dates, e.g. '%d.%m.%Y',
+            parsed much faster than by calling strptime (see dates.py).  'auto' detects the format on the first rows.
         Header_TransactionDate: [Mandatory] Column title for 'date of transaction' field         
 
     OFX export uses these keys:
@@ -49,6 +75,8 @@
         DTPOSTED: date the transaction was posted (YYYYMMDD)
         TRNAMT: amount of transaction
         FITID: a unique transaction identifier (for avoiding duplicate imports)
+            TransactionHash(amount,payee) gives an id that is the same in every
+            statement the transaction is in.
         PAYEE: who the transaction was posted to/from
         MEMO: the memo
         CURDEF: currency def.  e.g. USD
@@ -79,6 +107,8 @@
 """
 
 from csvutils import *
+from fields import *
+from dates import date_parser
 
 # General local utilities
 def DatetimeToOfxDate(dt):
@@ -87,9 +117,12 @@ def DatetimeToOfxDate(dt):
 def DatetimeToQifDate(dt):
     return dt.strftime('%m/%d/%Y')
 
+ToDatetime_mdy = date_parser('%m/%d/%y')
+ToDatetime_mdY = date_parser('%m/%d/%Y')
+
 def GenericToDatetime(date):
-    yearlen=len(date.split('/')[-1])
-    return datetime.strptime(date,yearlen==2 and '%m/%d/%y' or '%m/%d/%Y')
+    yearlen=len(date)-date.rfind('/')-1
+    return yearlen==2 and ToDatetime_mdy(date) or ToDatetime_mdY(date)
 
 def yodlee_dscr(row,grid):
     " use user description for payee 1st, the original description"
@@ -113,28 +146,28 @@ yodlee = {
         'Header_TransactionDate': 'Date'                            # Mandatory
     },
     'OFX':{
-        'skip':lambda row,grid: fromCSVCol(row,grid,'Split Type') == 'Split',
-        'BANKID':lambda row,grid: fromCSVCol(row,grid,'Account Name').split(' - ')[0],
-        'ACCTID':lambda row,grid: fromCSVCol(row,grid,'Account Name').split(' - ')[-1], 
-        'DTPOSTED':lambda row,grid: DatetimeToOfxDate(grid.GetDatetime(row)),
-        'TRNAMT':lambda row,grid: fromCSVCol(row,grid,'Amount'),
-        'FITID':lambda row,grid: fromCSVCol(row,grid,'Transaction Id'),
+        'skip':Equals(CSVCol('Split Type'),'Split'),
+        'BANKID':Split(CSVCol('Account Name'),' - ',0),
+        'ACCTID':Split(CSVCol('Account Name'),' - ',-1), 
+        'DTPOSTED':TransactionDate('%Y%m%d'),
+        'TRNAMT':Amount(CSVCol('Amount')),
+        'FITID':CSVCol('Transaction Id'),
         'PAYEE':lambda row,grid: yodlee_dscr(row,grid),
         'MEMO':lambda row,grid: yodlee_memo(row,grid),
-        'CURDEF':lambda row,grid: fromCSVCol(row,grid,'Currency'),
-        'CHECKNUM':lambda row,grid: fromCSVCol(row,grid,'Transaction Id') 
+        'CURDEF':CSVCol('Currency',clean=True),
+        'CHECKNUM':CSVCol('Transaction Id') 
     },
     'QIF':{
-        'split':lambda row,grid: fromCSVCol(row,grid,'Split Type') == 'Split',
-        'Account':lambda row,grid: fromCSVCol(row,grid,'Account Name'),
+        'split':Equals(CSVCol('Split Type'),'Split'),
+        'Account':CSVCol('Account Name'),
         'AccountDscr':lambda row,grid: ' '.join(fromCSVCol(row,grid,'Account Name').split('-')[1:]),
-        'Date':lambda row,grid: DatetimeToQifDate(grid.GetDatetime(row)),
-        'Payee':lambda row,grid: fromCSVCol(row,grid,'Original Description'),
-        'Memo':lambda row,grid: fromCSVCol(row,grid,'User Description') + ' ' + fromCSVCol(row,grid,'Memo'),
-        'Category':lambda row,grid: fromCSVCol(row,grid,'Category')+'-'+fromCSVCol(row,grid,'Classification'),
-        'Class':lambda row,grid: '', 
-        'Amount':lambda row,grid: fromCSVCol(row,grid,'Amount'),
-        'Number':lambda row,grid: fromCSVCol(row,grid,'Transaction Id')
+        'Date':TransactionDate('%m/%d/%Y'),
+        'Payee':CSVCol('Original Description'),
+        'Memo':Join(' ',CSVCol('User Description'),CSVCol('Memo')),
+        'Category':Join('-',CSVCol('Category'),CSVCol('Classification')),
+        'Class':Const(''), 
+        'Amount':Amount(CSVCol('Amount')),
+        'Number':CSVCol('Transaction Id')
     }
 }
 
@@ -144,40 +177,40 @@ cu = {
         'Header_TransactionDate': 'Date'                            # Mandatory
     },
     'OFX':{
-        'skip':lambda row,grid: False,
-        'BANKID':lambda row,grid: 'Credit Union',
-        'ACCTID':lambda row,grid: 'My Account',
-        'DTPOSTED':lambda row,grid: DatetimeToOfxDate(grid.GetDatetime(row)),
-        'TRNAMT':lambda row,grid: fromCSVCol(row,grid,'Amount').replace('$',''),
-        'FITID':lambda row,grid: row,
-        'PAYEE':lambda row,grid: fromCSVCol(row,grid,'Description'),
-        'MEMO':lambda row,grid: fromCSVCol(row,grid,'Comments'),
-        'CURDEF':lambda row,grid: 'USD',
-        'CHECKNUM':lambda row,grid: fromCSVCol(row,grid,'Check Number')
+        'skip':Const(False),
+        'BANKID':Const('Credit Union'),
+        'ACCTID':Const('My Account'),
+        'DTPOSTED':TransactionDate('%Y%m%d'),
+        'TRNAMT':Amount(CSVCol('Amount')),
+        'FITID':RowNumber(),
+        'PAYEE':CSVCol('Description'),
+        'MEMO':CSVCol('Comments'),
+        'CURDEF':Const('USD'),
+        'CHECKNUM':CSVCol('Check Number')
     },
     'QIF':{
-        'split':lambda row,grid:False,
-        'Account':lambda row,grid: 'Credit Union',
-        'AccountDscr':lambda row,grid: 'Credit Union Account',
-        'Date':lambda row,grid: DatetimeToQifDate(grid.GetDatetime(row)),
-        'Payee':lambda row,grid: fromCSVCol(row,grid,'Description'),
-        'Memo':lambda row,grid: fromCSVCol(row,grid,'Comments'),
-        'Category':lambda row,grid:'Unclassified',
-        'Class':lambda row,grid:'',
-        'Amount':lambda row,grid:fromCSVCol(row,grid,'Amount'),
-        'Number':lambda row,grid:fromCSVCol(row,grid,'Check Number')        
+        'split':Const(False),
+        'Account':Const('Credit Union'),
+        'AccountDscr':Const('Credit Union Account'),
+        'Date':TransactionDate('%m/%d/%Y'),
+        'Payee':CSVCol('Description'),
+        'Memo':CSVCol('Comments'),
+        'Category':Const('Unclassified'),
+        'Class':Const(''),
+        'Amount':Amount(CSVCol('Amount')),
+        'Number':CSVCol('Check Number')        
     }
 }
 
-def ubs_DateStrToDatetime(strDate):
-    return datetime.strptime(strDate,'%d.%m.%Y')
+ubs_DateStrToDatetime = date_parser('%d.%m.%Y')
 
+# kept for custom mappings, the UBS mapping uses DebitCredit
 def ubs_toAmount(debit,credit):
-    amount = 0
+    amount = Cents(0)
     if debit:
-        amount -= float(debit.replace('\'',''))
+        amount -= parse_cents(debit)
     if credit:
-        amount += float(credit.replace('\'',''))
+        amount += parse_cents(credit)
     return amount
 
 def ubs_toPayee(enteredby,recipient,description):
@@ -197,38 +230,40 @@ ubs = {
     '_params':{
         'delimiter': ';',
         'skip_last': 1,
-        'Function_DateStrToDatetime': ubs_DateStrToDatetime,        # Mandatory
+        'DateFormat': '%d.%m.%Y',                                   # Mandatory (or Function_DateStrToDatetime)
         'Header_TransactionDate': 'Value date'                      # Mandatory
     },
     'OFX':{
-        'skip':lambda row,grid: False,
-        'BANKID':lambda row,grid: 'UBS',
-        'ACCTID':lambda row,grid: fromCSVCol(row,grid,'Description'),
-        'DTPOSTED':lambda row,grid: DatetimeToOfxDate(grid.GetDatetime(row)),
-        'TRNAMT':lambda row,grid: ubs_toAmount(fromCSVCol(row,grid,'Debit'),fromCSVCol(row,grid,'Credit')),
-        'FITID':lambda row,grid: row,
-        'PAYEE':lambda row,grid: ubs_toPayee(fromCSVCol(row,grid,'Entered by'),fromCSVCol(row,grid,'Recipient')),
-        'MEMO':lambda row,grid: ubs_toDescription(fromCSVCol(row,grid,'Description 1'),
-                                                  fromCSVCol(row,grid,'Description 2'),
-                                                  fromCSVCol(row,grid,'Description 3')),
-        'CURDEF':lambda row,grid: fromCSVCol(row,grid,'Ccy.'),
-        'CHECKNUM':lambda row,grid: ''
+        'skip':Const(False),
+        'BANKID':Const('UBS'),
+        'ACCTID':CSVCol('Description'),
+        'DTPOSTED':TransactionDate('%Y%m%d'),
+        'TRNAMT':DebitCredit(CSVCol('Debit'),CSVCol('Credit')),
+        'FITID':RowNumber(),
+        'PAYEE':lambda row,grid: ubs_toPayee(fromCSVCol(row,grid,'Entered by'),
+                                             fromCSVCol(row,grid,'Recipient'),
+                                             fromCSVCol(row,grid,'Description 3')),
+        'MEMO':JoinNonEmpty(' / ',CSVCol('Description 1'),
+                                  CSVCol('Description 2'),
+                                  CSVCol('Description 3')),
+        'CURDEF':CSVCol('Ccy.',clean=True),
+        'CHECKNUM':Const('')
     },
     'QIF':{
-        'split':lambda row,grid:False,
-        'Account':lambda row,grid: 'UBS',
-        'AccountDscr':lambda row,grid: fromCSVCol(row,grid,'Description'),
-        'Date':lambda row,grid: DatetimeToQifDate(grid.GetDatetime(row)),
+        'split':Const(False),
+        'Account':Const('UBS'),
+        'AccountDscr':CSVCol('Description'),
+        'Date':TransactionDate('%m/%d/%Y'),
         'Payee':lambda row,grid: ubs_toPayee(fromCSVCol(row,grid,'Entered by'),
                                              fromCSVCol(row,grid,'Recipient'),
                                              fromCSVCol(row,grid,'Description 3')),
-        'Memo':lambda row,grid: ubs_toDescription(fromCSVCol(row,grid,'Description 1'),
-                                                  fromCSVCol(row,grid,'Description 2'),
-                                                  fromCSVCol(row,grid,'Description 3')),
-        'Category':lambda row,grid:'Unclassified',
-        'Class':lambda row,grid:'',
-        'Amount':lambda row,grid: ubs_toAmount(fromCSVCol(row,grid,'Debit'),fromCSVCol(row,grid,'Credit')),
-        'Number':lambda row,grid: ''        
+        'Memo':JoinNonEmpty(' / ',CSVCol('Description 1'),
+                                  CSVCol('Description 2'),
+                                  CSVCol('Description 3')),
+        'Category':Const('Unclassified'),
+        'Class':Const(''),
+        'Amount':DebitCredit(CSVCol('Debit'),CSVCol('Credit')),
+        'Number':Const('')        
     }
 }
 
@@ -246,103 +281,101 @@ msmoneyrep = {
         'Header_TransactionDate': 'Date'                            # Mandatory
     },
     'OFX':{
-        'skip':lambda row,grid: fromCSVCol(row,grid,'Split Type') == 'Split',
-        'BANKID':lambda row,grid: fromCSVCol(row,grid,'Account Name').split(' - ')[0],
-        'ACCTID':lambda row,grid: fromCSVCol(row,grid,'Account Name').split(' - ')[-1],
-        'DTPOSTED':lambda row,grid: DatetimeToOfxDate(grid.GetDatetime(row)),
-        'TRNAMT':lambda row,grid: fromCSVCol(row,grid,'Amount'),
-        'FITID':lambda row,grid: fromCSVCol(row,grid,'Num'),
-        'PAYEE':lambda row,grid: fromCSVCol(row,grid,'Payee'),
+        'skip':Equals(CSVCol('Split Type'),'Split'),
+        'BANKID':Split(CSVCol('Account Name'),' - ',0),
+        'ACCTID':Split(CSVCol('Account Name'),' - ',-1),
+        'DTPOSTED':TransactionDate('%Y%m%d'),
+        'TRNAMT':Amount(CSVCol('Amount')),
+        'FITID':CSVCol('Num'),
+        'PAYEE':CSVCol('Payee'),
         'MEMO':lambda row,grid: msmoney_memo(row,grid),
-        'CURDEF':lambda row,grid: fromCSVCol(row,grid,'Currency'),
-        'CHECKNUM':lambda row,grid: fromCSVCol(row,grid,'Num')
+        'CURDEF':CSVCol('Currency',clean=True),
+        'CHECKNUM':CSVCol('Num')
     },
     'QIF':{
-        'split':lambda row,grid: fromCSVCol(row,grid,'Date') == '', #split should be determined by absence of date and other fields.
-        'Account':lambda row,grid: fromCSVCol(row,grid,'Account'),
-        'AccountDscr':lambda row,grid: fromCSVCol(row,grid,'Account'),
-        'Date':lambda row,grid: DatetimeToQifDate(grid.GetDatetime(row)),
+        'split':Equals(CSVCol('Date'),''), #split should be determined by absence of date and other fields.
+        'Account':CSVCol('Account'),
+        'AccountDscr':CSVCol('Account'),
+        'Date':TransactionDate('%m/%d/%Y'),
         #TODO: parse_payee is undefined!
         'Payee':lambda row,grid: parse_payee(row,grid),
-        'Memo':lambda row,grid: fromCSVCol(row,grid,'C') + ': ' + fromCSVCol(row,grid,'Memo'),
-        'Category':lambda row,grid: fromCSVCol(row,grid,'Category'),
-        'Class':lambda row,grid: fromCSVCol(row,grid,'Projects'),
-        'Amount':lambda row,grid: fromCSVCol(row,grid,'Amount'),
-        'Number':lambda row,grid: fromCSVCol(row,grid,'Num')
+        'Memo':Join(': ',CSVCol('C'),CSVCol('Memo')),
+        'Category':CSVCol('Category'),
+        'Class':CSVCol('Projects'),
+        'Amount':Amount(CSVCol('Amount')),
+        'Number':CSVCol('Num')
     }
 }
 
 # Citibank Canada Master Card (French statement)
-def CitiFr_DateStrToDatetime(strDate):
-    return datetime.strptime(strDate,'%d/%m/%Y')
+CitiFr_DateStrToDatetime = date_parser('%d/%m/%Y')
 
 CitiMC_French = {
     '_params':{
         'maptype': 'creditcard',
         'skip_last': 1,
-        'Function_DateStrToDatetime': CitiFr_DateStrToDatetime,     # Mandatory
+        'DateFormat': '%d/%m/%Y',                                   # Mandatory (or Function_DateStrToDatetime)
         'Header_TransactionDate': 'Date de l\'opration'              # Mandatory
     },
     'OFX':{
-        'skip':lambda row,grid: False,
-        'BANKID':lambda row,grid: 'Citibank Canada',
-        'ACCTID':lambda row,grid: 'MasterCard Citi',
-        'DTPOSTED':lambda row,grid: grid.GetDatetime(row).strftime('%Y%m%d'),
-        'TRNAMT':lambda row,grid: inverseSign(fromCSVCol(row,grid,'Montant')),
+        'skip':Const(False),
+        'BANKID':Const('Citibank Canada'),
+        'ACCTID':Const('MasterCard Citi'),
+        'DTPOSTED':TransactionDate('%Y%m%d'),
+        'TRNAMT':InverseSign(CSVCol('Montant')),
         'FITID':lambda row,grid: grid.GenerateTransactionId(row),
-        'PAYEE':lambda row,grid: fromCSVCol(row,grid,'Description'),
-        'MEMO':lambda row,grid: '',
-        'CURDEF':lambda row,grid: 'CAD',
-        'CHECKNUM':lambda row,grid: ''
+        'PAYEE':CSVCol('Description'),
+        'MEMO':Const(''),
+        'CURDEF':Const('CAD'),
+        'CHECKNUM':Const('')
     },
     'QIF':{
-        'split':lambda row,grid:False,
-        'Account':lambda row,grid: 'MasterCard Citi',
-        'AccountDscr':lambda row,grid: '',
-        'Date':lambda row,grid: grid.GetDatetime(row).strftime('%m/%d/%Y'),
-        'Payee':lambda row,grid: fromCSVCol(row,grid,'Description'),
-        'Memo':lambda row,grid: '',
-        'Category':lambda row,grid:'Unclassified',
-        'Class':lambda row,grid:'',
-        'Amount':lambda row,grid: inverseSign(fromCSVCol(row,grid,'Montant')),
-        'Number':lambda row,grid: ''
+        'split':Const(False),
+        'Account':Const('MasterCard Citi'),
+        'AccountDscr':Const(''),
+        'Date':TransactionDate('%m/%d/%Y'),
+        'Payee':CSVCol('Description'),
+        'Memo':Const(''),
+        'Category':Const('Unclassified'),
+        'Class':Const(''),
+        'Amount':InverseSign(CSVCol('Montant')),
+        'Number':Const('')
     }
 }
 
 # Citibank Canada Master Card (English statement)
-def CitiEng_DateStrToDatetime(strDate):
-    return datetime.strptime(strDate,'%m/%d/%Y')
+CitiEng_DateStrToDatetime = date_parser('%m/%d/%Y')
 
 CitiMC_English = {
     '_params':{
         'maptype': 'creditcard',                                        # Optional (defaults to 'bank'
         'skip_last': 1,                                             # Optional
-        'Function_DateStrToDatetime': CitiEng_DateStrToDatetime,    # Mandatory
+        'DateFormat': '%m/%d/%Y',                                   # Mandatory (or Function_DateStrToDatetime)
         'Header_TransactionDate': 'Transaction Date'                # Mandatory
     },
     'OFX':{
-        'skip':lambda row,grid: False,
-        'BANKID':lambda row,grid: 'Citibank Canada',
-        'ACCTID':lambda row,grid: 'Citi MasterCard',
-        'DTPOSTED':lambda row,grid: DatetimeToOfxDate(grid.GetDatetime(row)),
-        'TRNAMT':lambda row,grid: inverseSign(fromCSVCol(row,grid,'Amount')),
+        'skip':Const(False),
+        'BANKID':Const('Citibank Canada'),
+        'ACCTID':Const('Citi MasterCard'),
+        'DTPOSTED':TransactionDate('%Y%m%d'),
+        'TRNAMT':InverseSign(CSVCol('Amount')),
         'FITID':lambda row,grid: grid.GenerateTransactionId(row),
-        'PAYEE':lambda row,grid: fromCSVCol(row,grid,'Description'),
-        'MEMO':lambda row,grid: '',
-        'CURDEF':lambda row,grid: 'CAD',
-        'CHECKNUM':lambda row,grid: ''
+        'PAYEE':CSVCol('Description'),
+        'MEMO':Const(''),
+        'CURDEF':Const('CAD'),
+        'CHECKNUM':Const('')
     },
     'QIF':{
-        'split':lambda row,grid:False,
-        'Account':lambda row,grid: 'Citi MasterCard',
-        'AccountDscr':lambda row,grid: '',
-        'Date':lambda row,grid: DatetimeToQifDate(grid.GetDatetime(row)),
-        'Payee':lambda row,grid: fromCSVCol(row,grid,'Description'),
-        'Memo':lambda row,grid: '',
-        'Category':lambda row,grid:'Unclassified',
-        'Class':lambda row,grid:'',
-        'Amount':lambda row,grid: inverseSign(fromCSVCol(row,grid,'Amount')),
-        'Number':lambda row,grid: ''
+        'split':Const(False),
+        'Account':Const('Citi MasterCard'),
+        'AccountDscr':Const(''),
+        'Date':TransactionDate('%m/%d/%Y'),
+        'Payee':CSVCol('Description'),
+        'Memo':Const(''),
+        'Category':Const('Unclassified'),
+        'Class':Const(''),
+        'Amount':InverseSign(CSVCol('Amount')),
+        'Number':Const('')
     }
 }
 
@@ -0,0 +1,273 @@
+
+"""
+    Merging overlapping statements.
+
+    Consecutive statement downloads overlap, so converting each file
+    exports the transactions of the overlap more than once.  merge_files
+    maps the transactions of many csv files, sorts them by posted date
+    and writes one OFX or QIF file per account in which every transaction
+    is exported once.
+
+    The transactions are sorted like an external sort: runs of RUN_SIZE
+    transactions are sorted in memory and spilled to temporary files,
+    then the runs are merged (heapq.merge).  No more than FAN_IN runs are
+    kept: when there are FAN_IN, the shorter half of them is merged into
+    one longer run, so any number of files can be merged in bounded
+    memory and with a bounded number of open temporary files.  A transaction is a duplicate when its
+    account already has a transaction with the same key: its content
+    hash (see fields.TransactionHash) or its FITID.
+"""
+
+import os
+import heapq
+import marshal
+from datetime import datetime, date
+from tempfile import TemporaryFile
+
+from csvutils import spill_buffer, xmlize
+from fields import compile_field, compile_mapping, TransactionHash
+from amounts import transaction_type
+import ofx, qif
+
+# transactions sorted in memory before they are spilled to disk
+RUN_SIZE = 1<<16
+# runs merged at a time, each is an open temporary file
+FAN_IN = 64
+# what tells duplicate transactions apart, see transaction_key
+KEYS = ('hash', 'fitid')
+
+
+def transaction_key(mapping, format, key):
+    """
+        The field of the format mapping identifying a transaction:
+        'hash' the TransactionHash of its amount and payee, 'fitid' the
+        FITID field (OFX, or QIF mappings that have one).
+    """
+    if key == 'fitid':
+        if 'FITID' not in mapping:
+            raise ValueError("The %s mapping has no FITID to merge by" % format)
+        return mapping['FITID']
+    if format == 'OFX':
+        return TransactionHash(mapping['TRNAMT'], mapping['PAYEE'])
+    return TransactionHash(mapping['Amount'], mapping['Payee'])
+
+
+# the records of the transactions of a file, sorted and merged as
+# (day, file number, row, account, key, account fields, text)
+
+def ofx_records(mapping, grid, file_no, writer, key):
+    skip = compile_field(mapping['skip'],grid)
+    fields = compile_mapping(mapping,ofx.FIELDS,grid,xmlize,'OFX')
+    keys = compile_field(key,grid)
+    transaction = writer.transaction
+    for rows in grid.iterblocks():
+        rows = [row for row, skipped in zip(rows,skip(rows)) if not skipped]
+        for row, values, tran_key in zip(rows,fields(rows),keys(rows)):
+            bankid, acctid, currency, dtposted, trnamt, fitid, payee, memo, checknum = values
+            text = transaction(transaction_type(trnamt), dtposted, trnamt, fitid, payee, memo, checknum)
+            yield (grid.GetDatetime(row).toordinal(), file_no, row, "%s-%s" % (bankid, acctid),
+                   str(tran_key), (bankid, acctid, currency), text)
+
+def qif_records(mapping, grid, file_no, key):
+    split = compile_field(mapping['split'],grid)
+    fields = compile_mapping(mapping,qif.FIELDS,grid,qif.oneline,'QIF')
+    split_fields = compile_mapping(mapping,qif.SPLIT_FIELDS,grid,qif.oneline,'QIF split')
+    keys = compile_field(key,grid)
+    # a transaction is complete when the next one starts, its split
+    # rows follow it
+    record = None
+    for rows in grid.iterblocks():
+        is_split = split(rows)
+        parent_rows = [row for row, s in zip(rows,is_split) if not s]
+        trans = iter(fields(parent_rows))
+        tran_keys = iter(keys(parent_rows))
+        splits = iter(split_fields([row for row, s in zip(rows,is_split) if s]))
+        for row, s in zip(rows,is_split):
+            if not s:
+                if record is not None:
+                    yield tuple(record[:-1]) + (''.join(record[-1]) + "^\n",)
+                tran = dict(zip(qif.FIELDS,trans.next()))
+                record = [grid.GetDatetime(row).toordinal(), file_no, row, tran['Account'],
+                          str(tran_keys.next()), (tran['AccountDscr'],),
+                          ["D%(Date)s\nT%(Amount)s\nP%(Payee)s\nM%(Memo)s\nL%(Category)s/%(Class)s\n" % tran]]
+            else:
+                if record is None:
+                    raise Exception ( "Split row %s has no parent transaction" % row )
+                record[-1].append("S%(Category)s/%(Class)s\nE%(Memo)s\n$%(Amount)s\n" % dict(zip(qif.SPLIT_FIELDS,splits.next())))
+    if record is not None:
+        yield tuple(record[:-1]) + (''.join(record[-1]) + "^\n",)
+
+
+def _spill(run):
+    """
+        The sorted run of records written to a temporary file.
+    """
+    f = TemporaryFile()
+    for record in run:
+        marshal.dump(record,f)
+    f.seek(0)
+    return f
+
+def _read_run(f):
+    try:
+        while True:
+            yield marshal.load(f)
+    except EOFError:
+        pass
+    finally:
+        f.close()
+
+def sorted_runs(records, run_size=RUN_SIZE):
+    """
+        Generates the records in sorted runs, each generating its records
+        in order.  Every run but the last, a sorted list, is spilled to a
+        temporary file.
+    """
+    run = []
+    for record in records:
+        run.append(record)
+        if len(run) >= run_size:
+            run.sort()
+            yield _read_run(_spill(run))
+            run = []
+    run.sort()
+    yield run
+
+def _merge_runs(runs):
+    """
+        The runs merged into one run spilled to a temporary file.
+    """
+    return _read_run(_spill(heapq.merge(*runs)))
+
+def add_run(levels, run, fan_in=FAN_IN):
+    """
+        Adds the spilled run to levels, lists of runs where the runs of
+        a level are merges of runs of the levels below.  Once fan_in runs
+        are open, the runs of the lowest levels (at least half of them)
+        are merged into one run of the level above, so there are always
+        fewer than fan_in and each transaction is merged again only a
+        few times.
+    """
+    if not levels:
+        levels.append([])
+    levels[0].append(run)
+    if sum(map(len,levels)) < fan_in:
+        return
+    group, level = [], 0
+    while len(group) < fan_in//2:
+        group.extend(levels[level])
+        levels[level] = []
+        level += 1
+    if level == len(levels):
+        levels.append([])
+    levels[level].append(_merge_runs(group))
+
+
+def merge_files(tables, format, out_dir, key='hash', compact=False, since=None, until=None):
+    """
+        Merges the transactions of tables into one export file per
+        account in out_dir.
+
+        tables: generates (mapping, grid) for each csv file, mapping is
+            the whole mapping (with '_params').  Only one grid is needed
+            at a time.
+        format: 'OFX' or 'QIF'
+        key: 'hash' or 'fitid', see transaction_key
+        compact: write OFX without the pretty print whitespace
+        since, until: the dates the tables were read between (see
+            CSVTable), the DTSTART and DTEND of the accounts if given
+
+        Returns (account, path, transactions, duplicates) for each account.
+    """
+    today = datetime.now().strftime('%Y%m%d')
+    writer = ofx.OFXWriter(compact)
+    levels = []
+    # the last run of the last file, in memory
+    last_run = []
+    maptypes = {}
+    for file_no, (mapping, grid) in enumerate(tables):
+        if last_run:
+            add_run(levels, _read_run(_spill(last_run)), FAN_IN)
+        format_mapping = mapping[format]
+        tran_key = transaction_key(format_mapping, format, key)
+        if format == 'OFX':
+            records = ofx_records(format_mapping, grid, file_no, writer, tran_key)
+        else:
+            records = qif_records(format_mapping, grid, file_no, tran_key)
+        for run in sorted_runs(records, RUN_SIZE):
+            if isinstance(run, list):
+                last_run = run
+            else:
+                add_run(levels, run, FAN_IN)
+        maptypes[file_no] = mapping['_params'].get('maptype','bank')
+    runs = [run for level in levels for run in level] + [last_run]
+
+    accounts = {}
+    order = []
+    # the keys seen for each account.  A content hash includes the date,
+    # so only those of the day being merged are kept.
+    seen = set()
+    day = None
+    try:
+        for record in heapq.merge(*runs):
+            tran_day, file_no, row, account, tran_key, account_fields, text = record
+            if tran_day != day and key == 'hash':
+                seen.clear()
+            day = tran_day
+            acct = accounts.get(account)
+            if acct is None:
+                acct = accounts[account] = {'trans':spill_buffer(), 'count':0, 'duplicates':0,
+                                            'maptype':maptypes[file_no], 'start':tran_day}
+                if format == 'OFX':
+                    acct['BANKID'], acct['ACCTID'], acct['CURDEF'] = account_fields
+                    acct['TODAY'] = today
+                else:
+                    acct['Account'] = account
+                order.append(account)
+            if (account, tran_key) in seen:
+                acct['duplicates'] += 1
+                continue
+            seen.add((account, tran_key))
+            if format == 'QIF':
+                # the description of the last transaction is used
+                acct['AccountDscr'] = account_fields[0]
+            acct['end'] = tran_day
+            acct['count'] += 1
+            acct['trans'].write(text)
+
+        results = []
+        # the file names taken, in lower case for case insensitive file systems
+        names = set()
+        for account in order:
+            acct = accounts[account]
+            path = os.path.join(out_dir, account_file_name(account, format, names))
+            if format == 'OFX':
+                acct['DTSTART'] = (since or date.fromordinal(acct['start'])).strftime('%Y%m%d')
+                acct['DTEND'] = (until or date.fromordinal(acct['end'])).strftime('%Y%m%d')
+                writer.write(path, {account:acct}, acct['maptype'], today)
+            else:
+                qif.write(path, {account:acct}, acct['maptype'])
+            results.append((account, path, acct['count'], acct['duplicates']))
+        return results
+    finally:
+        for acct in accounts.values():
+            acct['trans'].close()
+
+def account_file_name(account, format, taken=None):
+    """
+        The export file name of account, its letters, digits, '-' and
+        '_' with '_' for anything else.
+
+        taken: the lower case names given to other accounts, e.g. '12/34'
+            and '12 34' are both 12_34.ofx, so the second is 12_34-2.ofx.
+            The name is added to taken.
+    """
+    name = ''.join([(c.isalnum() or c in '-_') and c or '_' for c in str(account)])
+    file_name = "%s.%s" % (name, format.lower())
+    if taken is not None:
+        number = 1
+        while file_name.lower() in taken:
+            number += 1
+            file_name = "%s-%d.%s" % (name, number, format.lower())
+        taken.add(file_name.lower())
+    return file_name
@@ -0,0 +1,73 @@
+
+"""
+    Exporting OFX and QIF in one pass.
+
+    Exporting a statement to both formats one after the other reads the
+    rows twice and evaluates every field of both mapping sections.
+    export walks the rows once and hands each block to the collector of
+    every format (ofx.Collector, qif.Collector).  The fields the sections
+    have in common, e.g. the amount, the payee column or the split test,
+    are evaluated once per block (see fields.SharedColumns) and the
+    transaction dates are parsed once by the grid anyway.
+"""
+
+from datetime import datetime
+
+from fields import SharedColumns
+import ofx, qif
+import timing
+
+# the formats export writes, in the order they are collected
+FORMATS = ('OFX', 'QIF')
+
+
+def export(paths, mapping, maptype, grid, jobs=1, compact=False):
+    """
+        paths: {format: path to save the file}, e.g. {'OFX':'a.ofx', 'QIF':'a.qif'}
+        mapping: the whole mapping from mappings.py, with the section of
+            each format in paths
+        grid: csv data from csvutils.py, a CSVStream too since the rows
+            are read once
+        jobs: must be 1, the rows are mapped in this process
+        compact: write the OFX markup without pretty print whitespace
+    """
+    if jobs > 1:
+        raise ValueError("OFX and QIF are exported together in one process")
+    for format in paths:
+        if format not in FORMATS:
+            raise ValueError("Unhandled export format: %s" % format)
+    today = datetime.now().strftime('%Y%m%d')
+    writer = ofx.OFXWriter(compact)
+    shared = SharedColumns(grid)
+    accounts = dict([(format, {}) for format in paths])
+    try:
+        collectors = []
+        if 'OFX' in paths:
+            collectors.append(ofx.Collector(mapping['OFX'], grid, writer, today, accounts['OFX'], shared=shared))
+        if 'QIF' in paths:
+            collectors.append(qif.Collector(mapping['QIF'], grid, accounts['QIF'], shared=shared))
+        timing.stage('collect',collect)(grid, collectors)
+
+        if 'OFX' in paths:
+            timing.stage('write',ofx.write)(paths['OFX'], accounts['OFX'], maptype, grid, writer, today)
+        if 'QIF' in paths:
+            timing.stage('write',qif.write)(paths['QIF'], accounts['QIF'], maptype)
+    finally:
+        for format_accounts in accounts.values():
+            for acct in format_accounts.values():
+                acct['trans'].close()
+
+
+def collect(grid, collectors):
+    """
+        Hands each block of rows of grid to every collector, then calls
+        finish() of those that have one (qif.Collector, which closes the
+        last split transaction).
+    """
+    for rows in grid.iterblocks():
+        for collector in collectors:
+            collector.add(rows)
+    for collector in collectors:
+        finish = getattr(collector,'finish',None)
+        if finish is not None:
+            finish()
@@ -1,15 +1,171 @@
 
 from datetime import datetime
 import time
+import re
 
-def export ( path, mapping, maptype, grid):
+from csvutils import spill_buffer, copy_buffer, xmlize
+from fields import compile_field, compile_mapping, state_key
+import parallel
+import timing
+from amounts import transaction_type
+
+# the mapping fields evaluated for each transaction
+FIELDS = ('BANKID','ACCTID','CURDEF','DTPOSTED','TRNAMT','FITID','PAYEE','MEMO','CHECKNUM')
+
+def export ( path, mapping, maptype, grid, jobs=1, compact=False, state=None):
     """
         path: path to save the file
         mapping: mapping selected from mappings.py
         data: grid with csv data from csvutils.py
+        jobs: number of processes mapping the rows, see parallel.py
+        compact: write the OFX markup without pretty print whitespace
+        state: StateStore, only the transactions whose FITID it has not
+            seen are exported (see state.py).  A FITID that is the row
+            number or GenerateTransactionId is not kept from one statement
+            to the next, the TransactionHash of TRNAMT and PAYEE is
+            stored instead (see fields.state_key).  The rows are mapped
+            in this process then.
+    """
+
+    # transactions are written to a buffer per account as the rows are
+    # mapped, the buffers spill to disk so memory does not grow with the file
+    accounts={}
+    today = datetime.now().strftime('%Y%m%d')
+    writer = OFXWriter(compact)
+    try:
+        if jobs > 1 and state is None and parallel.can_split(grid, mapping):
+            for chunk_accounts, order in parallel.map_chunks(
+                    collect, (mapping, grid, writer, today), parallel.chunks(grid), jobs):
+                merge(accounts, chunk_accounts, order)
+        else:
+            timing.stage('collect',collect)(mapping, grid, writer, today, grid.iterblocks(), accounts, state=state)
+
+        timing.stage('write',write)(path, accounts, maptype, grid, writer, today)
+    finally:
+        for acct in accounts.values():
+            acct['trans'].close()
+
+
+def write(path, accounts, maptype, grid, writer, today):
+    """
+        Writes the accounts collected from grid with writer, the
+        statement covers the date range of grid.
+    """
+    # the date range is known once all rows have been seen
+    dtstart, dtend = grid.GetStatementRange()
+    for acct in accounts.values():
+        acct['DTSTART'] = dtstart.strftime('%Y%m%d')
+        acct['DTEND'] = dtend.strftime('%Y%m%d')
+    writer.write(path, accounts, maptype, today)
+
+
+def collect(mapping, grid, writer, today, blocks, accounts, buffer=spill_buffer, state=None):
+    """
+        Maps the rows in blocks and writes their STMTTRN to the 'trans'
+        buffer of their account in accounts, see Collector.
+
+        Returns the keys of the new accounts in the order they appeared.
+    """
+    collector = Collector(mapping, grid, writer, today, accounts, buffer, state)
+    for rows in blocks:
+        collector.add(rows)
+    return collector.order
+
+
+class Collector(object):
     """
+        Maps blocks of rows and writes their STMTTRN to the 'trans'
+        buffer of their account in accounts.  The markup of each block
+        is joined and written once per account.
 
-    bank_header = """
+        writer: the OFXWriter formatting the transactions
+        buffer: creates the buffer of a new account
+        state: StateStore, leave out the transactions it has seen
+        shared: fields.SharedColumns, the fields are evaluated once with
+            those of the other formats exported in the same pass
+        order: the keys of the new accounts in the order they appeared
+    """
+    def __init__(self, mapping, grid, writer, today, accounts, buffer=spill_buffer, state=None, shared=None):
+        self.today, self.accounts, self.buffer, self.state = today, accounts, buffer, state
+        self.order = []
+        self.skip = timing.field('OFX.skip',mapping['skip'],compile_field(mapping['skip'],grid,shared))
+        # the values are escaped for xml here, except for the clean fields
+        self.fields = compile_mapping(mapping,FIELDS,grid,xmlize,'OFX',shared)
+        self.transaction = timing.stage('format',writer.transaction)
+        if state is not None:
+            key_field = state_key(mapping,'TRNAMT','PAYEE')
+            self.key = timing.field('OFX.state',key_field,compile_field(key_field,grid,shared))
+
+    def add(self, rows):
+        accounts, state, transaction = self.accounts, self.state, self.transaction
+        # the mapping is evaluated for the rows that are not skipped
+        rows = [row for row, skipped in zip(rows,self.skip(rows)) if not skipped]
+        block = {}
+        if state is not None:
+            keys = iter(self.key(rows))
+        for bankid, acctid, currency, dtposted, trnamt, fitid, payee, memo, checknum in self.fields(rows):
+            # which account
+            uacct="%s-%s" % (bankid, acctid)
+            if state is not None and not state.is_new(uacct, keys.next()):
+                continue
+            trans = block.get(uacct)
+            if trans is None:
+                acct = accounts.get(uacct)
+                if acct is None:
+                    acct = accounts[uacct] = {
+                        'BANKID':bankid,
+                        'ACCTID':acctid,
+                        'TODAY':self.today,
+                        'CURDEF':currency,
+                        'trans':self.buffer()
+                    }
+                    self.order.append(uacct)
+                trans = block[uacct] = []
+            if currency != accounts[uacct]['CURDEF']:
+                print "Currency not the same."
+            trntype = transaction_type(trnamt)
+            trans.append(transaction(trntype, dtposted, trnamt, fitid, payee, memo, checknum))
+        for uacct, trans in block.items():
+            accounts[uacct]['trans'].write(''.join(trans))
+
+
+def merge(accounts, chunk_accounts, order):
+    """
+        Appends the accounts collected for a chunk of rows (with the text
+        in 'trans') to accounts.
+    """
+    for uacct in order:
+        chunk_acct = chunk_accounts[uacct]
+        acct = accounts.get(uacct)
+        if acct is None:
+            acct = accounts[uacct] = dict(chunk_acct, trans=spill_buffer())
+        elif chunk_acct['CURDEF'] != acct['CURDEF']:
+            print "Currency not the same."
+        acct['trans'].write(chunk_acct['trans'])
+
+
+# the pretty printed markup, OFXWriter derives the compact markup from it
+
+STMTTRN_START = """
+                        <STMTTRN>
+                            <TRNTYPE>%s</TRNTYPE>
+                            <DTPOSTED>%s</DTPOSTED>
+                            <TRNAMT>%s</TRNAMT>
+                            <FITID>%s</FITID>
+                """
+
+STMTTRN_CHECKNUM = """
+                            <CHECKNUM>%s</CHECKNUM>
+                """
+
+STMTTRN_END = """
+                            <NAME>%s</NAME>
+                            <MEMO>%s</MEMO>
+                """ + """
+                        </STMTTRN>
+                """
+
+BANK_HEADER = """
             <STMTRS>
                 <CURDEF>%(CURDEF)s</CURDEF>
                 <BANKACCTFROM>
@@ -18,8 +174,8 @@ def export ( path, mapping, maptype, grid):
                     <ACCTTYPE>CHECKING</ACCTTYPE>
                 </BANKACCTFROM>                    
             """
-            
-    credit_card_header = """
+
+CREDIT_CARD_HEADER = """
             <CCSTMTRS>
                 <CURDEF>%(CURDEF)s</CURDEF>
                 <CCACCTFROM>
@@ -27,36 +183,8 @@ def export ( path, mapping, maptype, grid):
                     <ACCTKEY>%(BANKID)s-%(ACCTID)s</ACCTKEY>
                 </CCACCTFROM>
             """
-            
-    accounts={}
-    today = datetime.now().strftime('%Y%m%d')
-    for row in range(grid.GetNumberRows()):
-        # which account            
-        if mapping['skip'](row,grid): continue
-        
-        uacct="%s-%s" % (mapping['BANKID'](row,grid), mapping['ACCTID'](row,grid))
-        acct = accounts.setdefault(uacct,{})
-        
-        acct['BANKID'] = mapping['BANKID'](row,grid)
-        acct['ACCTID'] = mapping['ACCTID'](row,grid)
-        acct['TODAY'] = today
-        acct['DTSTART'] = grid.GetMinDate().strftime('%Y%m%d')
-        acct['DTEND'] = grid.GetMaxDate().strftime('%Y%m%d')
-        currency = acct.setdefault('CURDEF',mapping['CURDEF'](row,grid))
-        if currency != mapping['CURDEF'](row,grid):
-            print "Currency not the same."
-        trans=acct.setdefault('trans',[])
-        tran=dict([(k,mapping[k](row,grid)) for k in ['DTPOSTED','TRNAMT','FITID','PAYEE','MEMO','CHECKNUM']])
-        tran['TRNTYPE'] = tran['TRNAMT'] >0 and 'CREDIT' or 'DEBIT'
-        trans.append(tran)
-        
-        
-    # output
-    
-    out=open(path,'w')
-    
-    out.write (
-        """
+
+OFX_HEADER = """
         <OFX>
             <SIGNONMSGSRSV1>
                <SONRS>
@@ -72,73 +200,84 @@ def export ( path, mapping, maptype, grid):
                 <TRNUID>%(TRNUID)d</TRNUID>
                 <STATUS><CODE>0</CODE><SEVERITY>INFO</SEVERITY></STATUS>
                 
-        """ % {'DTSERVER':today,
-              'TRNUID':int(time.mktime(time.localtime()))}
-    )
-        
-    for acct in accounts.values():
-        
-        if maptype == 'creditcard':
-            header = credit_card_header
-        else: #default to 'bank'
-            header = bank_header
-        
-        out.write( (header + """
+        """
+
+BANKTRANLIST = """
                 <BANKTRANLIST>
                     <DTSTART>%(DTSTART)s</DTSTART>
-                    <DTEND>%(DTEND)s</DTEND>""" ) % acct
-        )
-        
-        for tran in acct['trans']:
-            out.write (
-                """
-                        <STMTTRN>
-                            <TRNTYPE>%(TRNTYPE)s</TRNTYPE>
-                            <DTPOSTED>%(DTPOSTED)s</DTPOSTED>
-                            <TRNAMT>%(TRNAMT)s</TRNAMT>
-                            <FITID>%(FITID)s</FITID>
-                """ % tran
-            )
-            if tran['CHECKNUM'] is not None and len(tran['CHECKNUM'])>0:
-                out.write(
-                """
-                            <CHECKNUM>%(CHECKNUM)s</CHECKNUM>
-                """ % tran
-                )
-            out.write(
-                """
-                            <NAME>%(PAYEE)s</NAME>
-                            <MEMO>%(MEMO)s</MEMO>
-                """ % tran
-            )
-            out.write(
-                """
-                        </STMTTRN>
-                """
-            )
-        
-        out.write (
-            """
+                    <DTEND>%(DTEND)s</DTEND>"""
+
+LEDGERBAL = """
                 </BANKTRANLIST>
                 <LEDGERBAL>
                     <BALAMT>0</BALAMT>
                     <DTASOF>%s</DTASOF>
                 </LEDGERBAL>
-            """ % today )
+            """
+
+# size of the output file buffer
+WRITE_BUFFER = 1<<20
+
+
+def compact_markup(markup):
+    """
+        markup without the pretty print whitespace, that is any
+        whitespace containing a line break.
+    """
+    return re.sub(r'\s*\n\s*', '', markup)
+
+
+class OFXWriter(object):
+    """
+        Writes the OFX file.
 
+        The STMTTRN templates are prepared once, the transactions of an
+        account are formatted by transaction() and the file goes out
+        through a large write buffer.
+
+        compact: leave out the pretty print whitespace.  The markup is
+        the same, only the line breaks and indentation between the tags
+        are dropped.
+    """
+    def __init__(self, compact=False):
+        templates = (STMTTRN_START + STMTTRN_END,
+                     STMTTRN_START + STMTTRN_CHECKNUM + STMTTRN_END,
+                     BANK_HEADER, CREDIT_CARD_HEADER, OFX_HEADER, BANKTRANLIST, LEDGERBAL)
+        if compact:
+            templates = map(compact_markup, templates)
+        (self.stmttrn, self.stmttrn_checknum, self.bank_header, self.credit_card_header,
+         self.ofx_header, self.banktranlist, self.ledgerbal) = templates
+
+    def transaction(self, trntype, dtposted, trnamt, fitid, payee, memo, checknum):
+        """
+            The STMTTRN markup of one transaction.
+        """
+        if checknum is not None and len(checknum)>0:
+            return self.stmttrn_checknum % (trntype, dtposted, trnamt, fitid, checknum, payee, memo)
+        return self.stmttrn % (trntype, dtposted, trnamt, fitid, payee, memo)
+
+    def write ( self, path, accounts, maptype, today ):
+        """
+            path: path to save the file
+            accounts: account dicts, 'trans' holds the buffered STMTTRN markup
+            maptype: 'bank' or 'creditcard'
+            today: DTSERVER date
+        """
         if maptype == 'creditcard':
-            out.write("</CCSTMTRS>")
+            header, footer = self.credit_card_header, "</CCSTMTRS>"
         else: #default to 'bank'
-            out.write ("</STMTRS>")
-        
-    out.write ( "</STMTTRNRS></BANKMSGSRSV1></OFX>" )
-    out.close()
-    print "Exported %s" % path
-    
-    
-    
-    
-
-    
-    
-    
+            header, footer = self.bank_header, "</STMTRS>"
+
+        out=open(path,'w',WRITE_BUFFER)
+        try:
+            out.write ( self.ofx_header % {'DTSERVER':today,
+                                           'TRNUID':int(time.mktime(time.localtime()))} )
+            for acct in accounts.values():
+                out.write( (header + self.banktranlist) % acct )
+                copy_buffer(acct['trans'],out)
+                out.write( self.ledgerbal % today )
+                out.write( footer )
+            out.write ( "</STMTTRNRS></BANKMSGSRSV1></OFX>" )
+        finally:
+            out.close()
+        print "Exported %s" % path
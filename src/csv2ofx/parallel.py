@@ -0,0 +1,87 @@
+
+"""
+    Mapping the rows of one large csv file in worker processes.
+
+    The rows are cut into chunks of consecutive rows.  Each worker runs
+    the exporter's collect function over its chunks and sends back the
+    text written for each account.  The exporter merges the chunks in row
+    order, so the output is the same as converting in one process.
+
+    The grid and the mapping (which holds lambdas and can't be pickled)
+    are handed to the workers by forking, so this needs a platform with
+    fork.  Elsewhere, for a CSVStream and for mappings with fields that
+    count rows in order (TransactionHash), the rows are mapped serially.
+"""
+
+import os
+from cStringIO import StringIO
+
+from csvutils import CSVStream, BLOCK_SIZE
+
+# rows per chunk handed to a worker
+CHUNK_SIZE = 1<<16
+
+# (collect, args) of the running map_chunks, inherited by the workers
+_state = None
+
+
+def can_split(grid, mapping=None):
+    """
+        True if the rows of grid can be mapped in worker processes, with
+        mapping if given: its fields must not be ordered (see fields.py).
+    """
+    if mapping is not None and [f for f in mapping.values() if getattr(f,'ordered',False)]:
+        return False
+    return hasattr(os,'fork') and not isinstance(grid,CSVStream)
+
+def chunks(grid, size=CHUNK_SIZE, keep_with=None):
+    """
+        Cuts the rows of grid into (start, stop) chunks of about size rows.
+
+        keep_with: optional compiled field, a chunk is not allowed to start
+        on a row where it is true (e.g. a QIF split row that belongs to the
+        transaction before it).
+    """
+    rows = grid.GetNumberRows()
+    start = 0
+    while start < rows:
+        stop = min(start+size,rows)
+        while keep_with is not None and stop < rows and keep_with([stop])[0]:
+            stop += 1
+        yield start, stop
+        start = stop
+
+def _collect_chunk(chunk):
+    collect, args = _state
+    grid = args[1]
+    start, stop = chunk
+    accounts = {}
+    order = collect(*(args + (grid.iterblocks(BLOCK_SIZE,start,stop), accounts, StringIO)))
+    for acct in accounts.values():
+        acct['trans'] = acct['trans'].getvalue()
+    return accounts, order
+
+def map_chunks(collect, args, chunks, jobs):
+    """
+        Runs collect(*(args + (blocks, accounts, buffer))) for each chunk
+        in jobs worker processes.  args must start with (mapping, grid).
+
+        Generates (accounts, order) for each chunk in row order, where the
+        'trans' of each account is the text collect wrote for it.
+    """
+    global _state
+    # find the date range before forking so the workers don't each
+    # scan the whole file (e.g. for GenerateTransactionId)
+    args[1].GetDateRange()
+    _state = (collect, args)
+    # multiprocessing is slow to import, most conversions don't need it
+    from multiprocessing import Pool
+    pool = Pool(jobs)
+    try:
+        for result in pool.imap(_collect_chunk, chunks):
+            yield result
+        pool.close()
+    finally:
+        _state = None
+        pool.terminate()
+        pool.join()
@@ -1,28 +1,161 @@
 
+from csvutils import spill_buffer, copy_buffer
+from fields import compile_field, compile_mapping, state_key
+import parallel
+import timing
 
-def export ( path, mapping, maptype, grid ):
+# the mapping fields evaluated for transactions and for split rows
+FIELDS = ('Account', 'AccountDscr', 'Date', 'Payee', 'Memo', 'Category', 'Class', 'Amount', 'Number')
+SPLIT_FIELDS = ('Memo', 'Category', 'Class', 'Amount')
+
+def oneline(dat):
+    """
+        QIF values are a single line, line breaks are replaced by spaces.
+    """
+    if isinstance(dat,basestring) and '\n' in dat:
+        return dat.replace('\r\n',' ').replace('\n',' ')
+    return dat
+
+def export ( path, mapping, maptype, grid, jobs=1, state=None ):
     """
         path: file path to save file
         mapping: mapping for grid data
         grid: csv data
+        jobs: number of processes mapping the rows, see parallel.py
+        state: StateStore, only the transactions it has not seen are
+            exported (see state.py).  A transaction is identified by the
+            FITID field of the mapping if it has one that is not the row
+            number or GenerateTransactionId, else by the TransactionHash
+            of its Amount and Payee (see fields.state_key).  The rows are
+            mapped in this process then.
     """
 
-
+    # transactions are written to a buffer per account as the rows are
+    # mapped, the buffers spill to disk so memory does not grow with the file.
     accounts={}
-    cur_parent = None
-    for row in range(grid.GetNumberRows()):
-        tran = dict( [ (k, mapping[k](row,grid) ) for k in ('Date', 'Payee', 'Memo', 'Category', 'Class', 'Amount', 'Number' )] )
-        if not mapping['split'](row,grid):
-            acct = accounts.setdefault(mapping['Account'](row,grid),{})
-            acct['Account'] = mapping['Account'](row,grid)
-            acct['AccountDscr'] = mapping['AccountDscr'](row,grid)
-            trans = acct.setdefault('trans',[]) 
-            trans.append(tran)
-            cur_parent = tran
+    try:
+        if jobs > 1 and state is None and parallel.can_split(grid, mapping):
+            # a chunk must not start with a split row, it belongs to the
+            # transaction in the chunk before
+            chunks = parallel.chunks(grid, keep_with=compile_field(mapping['split'],grid))
+            for chunk_accounts, order in parallel.map_chunks(
+                    collect, (mapping, grid), chunks, jobs):
+                merge(accounts, chunk_accounts, order)
         else:
-            splits = cur_parent.setdefault('splits',[])
-            splits.append(tran)
+            timing.stage('collect',collect)(mapping, grid, grid.iterblocks(), accounts, state=state)
+
+        timing.stage('write',write)(path, accounts, maptype)
+    finally:
+        for acct in accounts.values():
+            acct['trans'].close()
+
+
+def collect(mapping, grid, blocks, accounts, buffer=spill_buffer, state=None):
+    """
+        Maps the rows in blocks and writes the transactions and their
+        splits to the 'trans' buffer of their account in accounts, see
+        Collector.
+
+        Returns the keys of the new accounts in the order they appeared.
+    """
+    collector = Collector(mapping, grid, accounts, buffer, state)
+    for rows in blocks:
+        collector.add(rows)
+    collector.finish()
+    return collector.order
+
+
+class Collector(object):
+    """
+        Maps blocks of rows and writes the transactions and their splits
+        to the 'trans' buffer of their account in accounts.  finish()
+        ends the last transaction.
+
+        buffer: creates the buffer of a new account
+        state: StateStore, leave out the transactions it has seen
+        shared: fields.SharedColumns, the fields are evaluated once with
+            those of the other formats exported in the same pass
+        order: the keys of the new accounts in the order they appeared
+    """
+    def __init__(self, mapping, grid, accounts, buffer=spill_buffer, state=None, shared=None):
+        self.accounts, self.buffer, self.state = accounts, buffer, state
+        self.order = []
+        # a transaction is ended (^) when the next non split row is seen
+        # since split rows follow their parent.
+        self.cur_parent = None
+        # the transaction being skipped, with its splits
+        self.skipping = False
+        self.split = timing.field('QIF.split',mapping['split'],compile_field(mapping['split'],grid,shared))
+        self.fields = compile_mapping(mapping,FIELDS,grid,oneline,'QIF',shared)
+        self.split_fields = compile_mapping(mapping,SPLIT_FIELDS,grid,oneline,'QIF split',shared)
+        if state is not None:
+            fitid_field = state_key(mapping,'Amount','Payee')
+            self.fitid = timing.field('QIF.FITID',fitid_field,compile_field(fitid_field,grid,shared))
+
+    def add(self, rows):
+        accounts, state = self.accounts, self.state
+        cur_parent, skipping = self.cur_parent, self.skipping
+        # parent and split rows are evaluated separately, then
+        # written in row order
+        is_split = self.split(rows)
+        parent_rows = [row for row, s in zip(rows,is_split) if not s]
+        trans = iter(self.fields(parent_rows))
+        splits = iter(self.split_fields([row for row, s in zip(rows,is_split) if s]))
+        if state is not None:
+            fitids = iter(self.fitid(parent_rows))
+        for row, s in zip(rows,is_split):
+            if not s:
+                if cur_parent is not None:
+                    cur_parent.write("^\n")
+                    cur_parent = None
+                tran = dict(zip(FIELDS,trans.next()))
+                account = tran['Account']
+                skipping = state is not None and not state.is_new(account, fitids.next())
+                if skipping:
+                    continue
+                acct = accounts.get(account)
+                if acct is None:
+                    acct = accounts[account] = {'Account':account, 'trans':self.buffer()}
+                    self.order.append(account)
+                acct['AccountDscr'] = tran['AccountDscr']
+                cur_parent = acct['trans']
+                cur_parent.write("D%(Date)s\nT%(Amount)s\nP%(Payee)s\nM%(Memo)s\nL%(Category)s/%(Class)s\n" % tran )
+            else:
+                tran = dict(zip(SPLIT_FIELDS,splits.next()))
+                if skipping:
+                    continue
+                if cur_parent is None:
+                    raise Exception ( "Split row %s has no parent transaction" % row )
+                cur_parent.write("S%(Category)s/%(Class)s\nE%(Memo)s\n$%(Amount)s\n" % tran )
+        self.cur_parent, self.skipping = cur_parent, skipping
 
+    def finish(self):
+        if self.cur_parent is not None:
+            self.cur_parent.write("^\n")
+            self.cur_parent = None
+
+
+def merge(accounts, chunk_accounts, order):
+    """
+        Appends the accounts collected for a chunk of rows (with the text
+        in 'trans') to accounts.
+    """
+    for account in order:
+        chunk_acct = chunk_accounts[account]
+        acct = accounts.get(account)
+        if acct is None:
+            acct = accounts[account] = dict(chunk_acct, trans=spill_buffer())
+        # the description of the last transaction is used
+        acct['AccountDscr'] = chunk_acct['AccountDscr']
+        acct['trans'].write(chunk_acct['trans'])
+
+
+def write ( path, accounts, maptype ):
+    """
+        path: file path to save file
+        accounts: account dicts, 'trans' holds the buffered transactions
+        maptype: 'bank' or 'creditcard'
+    """
 
     if maptype=='creditcard':
         header_type = 'CCard'
@@ -33,10 +166,6 @@ def export ( path, mapping, maptype, grid ):
     for a in accounts.values():
         o.write("!Account\nN%(Account)s\nD%(AccountDscr)s\n^\n" % a)
         o.write("!Type:%s\n" % header_type)
-        for t in a['trans']:
-            o.write("D%(Date)s\nT%(Amount)s\nP%(Payee)s\nM%(Memo)s\nL%(Category)s/%(Class)s\n" % t )
-            for s in t.get('splits',[]):
-                o.write("S%(Category)s/%(Class)s\nE%(Memo)s\n$%(Amount)s\n" % s )
-            o.write("^\n")
+        copy_buffer(a['trans'],o)
 
     o.close()
@@ -0,0 +1,236 @@
+
+"""
+    The mapping registry.
+
+    Custom mappings (csv2ofx_custom.py in the current directory, then in
+    the home directory) are preferred over the built in mappings.py.  The
+    custom file is imported as a module, so python caches its bytecode
+    next to it (csv2ofx_custom.pyc) instead of compiling it on every
+    start, and the mappings it defines don't end up in another module's
+    namespace.
+
+    Every mapping is checked by validate when its file is loaded.  The
+    validated mappings are kept until the file's modification time
+    changes, so a process loads them once.
+
+    detect_mapping finds the mapping of a csv file from the header line of
+    the file, so mixed batches convert without naming the mapping.
+"""
+
+import sys, os
+import imp
+import csv
+from types import FunctionType, CodeType
+from traceback import print_exc
+
+from fields import Field, CSVCol
+import ofx, qif
+
+# the module name of the custom mappings file
+CUSTOM_NAME = 'csv2ofx_custom'
+# the keys a mapping must have
+FORMAT_KEYS = {'OFX':('skip',) + ofx.FIELDS, 'QIF':('split',) + qif.FIELDS}
+
+# the longest header line read to find the mapping of a csv file
+SNIFF_SIZE = 8192
+
+# path -> (modification time, all_mappings) of the mapping files loaded
+_loaded = {}
+# (all_mappings, its index), see mapping_index
+_index = (None, None)
+
+
+class MappingError(Exception):
+    """
+        A mapping lacks a key it needs.
+    """
+    pass
+
+
+def custom_path():
+    """
+        The path of the custom mappings file, None if there is none.
+    """
+    homepath = os.path.expanduser('~')
+    for path in ('%s.py' % CUSTOM_NAME, os.path.join(homepath, '%s.py' % CUSTOM_NAME)):
+        if os.path.isfile(path):
+            return os.path.abspath(path)
+    return None
+
+def validate(name, mapping):
+    """
+        Raises MappingError if mapping (named name) lacks a mandatory
+        _params key or a function for a key of one of its formats.
+        Function_DateStrToDatetime may be replaced by a DateFormat.
+    """
+    params = mapping.get('_params')
+    if params is None:
+        raise MappingError("Mapping %s has no _params" % name)
+    if 'Header_TransactionDate' not in params:
+        raise MappingError("Mapping %s: _params has no Header_TransactionDate" % name)
+    if 'Function_DateStrToDatetime' in params:
+        if not callable(params['Function_DateStrToDatetime']):
+            raise MappingError("Mapping %s: Function_DateStrToDatetime is not a function" % name)
+    elif not isinstance(params.get('DateFormat'), basestring):
+        raise MappingError("Mapping %s: _params has neither Function_DateStrToDatetime nor DateFormat" % name)
+    formats = [format for format in sorted(FORMAT_KEYS) if format in mapping]
+    if not formats:
+        raise MappingError("Mapping %s has neither OFX nor QIF" % name)
+    for format in formats:
+        for key in FORMAT_KEYS[format]:
+            if not callable(mapping[format].get(key)):
+                raise MappingError("Mapping %s: %s has no function for %s" % (name, format, key))
+
+def _import_custom(path):
+    """
+        Imports the custom mappings file at path as a module.
+    """
+    # in the package, so the file can import csvutils and fields
+    package = __name__.rpartition('.')[0]
+    name = package and '%s.%s' % (package, CUSTOM_NAME) or CUSTOM_NAME
+    # a new module, not the one of a file loaded before
+    sys.modules.pop(name, None)
+    f, filename, description = imp.find_module(CUSTOM_NAME, [os.path.dirname(path)])
+    try:
+        return imp.load_module(name, f, filename, description)
+    finally:
+        if f is not None:
+            f.close()
+
+def _load(path, load):
+    """
+        The mappings of the all_mappings of the module load() returns for
+        the file at path that validate, loaded again only if the file
+        changed.  The error of a mapping that doesn't validate is printed
+        and the mapping left out; MappingError if none is left.
+    """
+    mtime = os.path.getmtime(path)
+    cached = _loaded.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    all_mappings = {}
+    for name, mapping in load().all_mappings.items():
+        try:
+            validate(name, mapping)
+        except MappingError, e:
+            print "%s: %s" % (path, e)
+            continue
+        all_mappings[name] = mapping
+    if not all_mappings:
+        raise MappingError("%s has no valid mappings" % path)
+    _loaded[path] = (mtime, all_mappings)
+    return all_mappings
+
+def load_mappings():
+    """
+        Returns the all_mappings dictionary of the custom mappings file,
+        or of the built in mappings if there is none or it fails to load.
+    """
+    path = custom_path()
+    if path is not None:
+        try:
+            return _load(path, lambda: _import_custom(path))
+        except:
+            print_exc()
+            print "Using Default Mappings"
+    import mappings
+    return _load(mappings.__file__, lambda: mappings)
+
+
+def _references(value, env, strings, columns, seen):
+    """
+        Adds the strings value refers to to strings and the names of its
+        CSVCol columns to columns, following declared fields, functions
+        (with the globals env) and the functions they call.
+    """
+    if isinstance(value, basestring):
+        strings.add(value)
+        return
+    if id(value) in seen:
+        return
+    seen.add(id(value))
+    if isinstance(value, CSVCol):
+        columns.add(value.col_name)
+        strings.add(value.col_name)
+    elif isinstance(value, Field):
+        for attr in vars(value).values():
+            _references(attr, env, strings, columns, seen)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _references(item, env, strings, columns, seen)
+    elif isinstance(value, FunctionType):
+        _references(value.func_code, value.func_globals, strings, columns, seen)
+    elif isinstance(value, CodeType):
+        for const in value.co_consts:
+            _references(const, env, strings, columns, seen)
+        for name in value.co_names:
+            called = env.get(name)
+            if isinstance(called, (FunctionType, Field)):
+                _references(called, env, strings, columns, seen)
+
+def signature(mapping):
+    """
+        (date column, columns, strings) of mapping: the columns the csv
+        file must have for it (Header_TransactionDate and the CSVCol
+        columns) and every string its fields refer to, among them the
+        columns its functions read.
+    """
+    strings, columns, seen = set(), set(), set()
+    for format in FORMAT_KEYS:
+        for field in mapping.get(format, {}).values():
+            _references(field, {}, strings, columns, seen)
+    date_column = mapping['_params']['Header_TransactionDate']
+    columns.add(date_column)
+    return date_column, frozenset(columns), frozenset(strings)
+
+def mapping_index(all_mappings):
+    """
+        {delimiter: [(name, signature)]} of all_mappings, built once for
+        the all_mappings last asked for.
+    """
+    global _index
+    if _index[0] is not all_mappings:
+        index = {}
+        for name, mapping in sorted(all_mappings.items()):
+            delimiter = mapping['_params'].get('delimiter', ',')
+            index.setdefault(delimiter, []).append((name, signature(mapping)))
+        _index = (all_mappings, index)
+    return _index[1]
+
+def detect_mapping(csv_path, all_mappings):
+    """
+        The name of the mapping in all_mappings for the csv file at
+        csv_path, found from its header (the first line that isn't blank,
+        up to SNIFF_SIZE bytes): the mapping must find all its columns
+        there and, of those that do, refers to the most header columns.
+        Raises MappingError if no mapping or more than one fits, or if
+        the header is longer than SNIFF_SIZE.
+    """
+    f = open(csv_path, 'rU')
+    try:
+        line = f.readline(SNIFF_SIZE)
+        while line and not line.strip():
+            line = f.readline(SNIFF_SIZE)
+    finally:
+        f.close()
+    if not line:
+        raise MappingError("%s has no header" % csv_path)
+    if not line.endswith('\n') and len(line) >= SNIFF_SIZE:
+        raise MappingError("The header of %s is longer than %d bytes" % (csv_path, SNIFF_SIZE))
+    line = line.rstrip('\n')
+    scores = []
+    for delimiter, signatures in mapping_index(all_mappings).items():
+        try:
+            header = set(csv.reader([line], delimiter=delimiter, quotechar='"').next())
+        except (csv.Error, StopIteration):
+            continue
+        for name, (date_column, columns, strings) in signatures:
+            if columns <= header:
+                scores.append((len(header & strings), name))
+    if not scores:
+        raise MappingError("No mapping fits the header of %s" % csv_path)
+    scores.sort(reverse=True)
+    best = [name for score, name in scores if score == scores[0][0]]
+    if len(best) > 1:
+        raise MappingError("The header of %s fits the mappings %s" % (csv_path, ', '.join(sorted(best))))
+    return best[0]
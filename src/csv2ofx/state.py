@@ -0,0 +1,97 @@
+
+"""
+    The state of incremental conversions.
+
+    A StateStore is an SQLite file that remembers, for one export format,
+    the content hash of the csv files converted and the FITIDs exported
+    for each account.  With a StateStore the batch conversion skips csv
+    files it converted before and the exporters leave out transactions
+    that were exported before, e.g. when a rolling 90 day statement is
+    converted every day only the new days are exported.
+"""
+
+import hashlib
+import sqlite3
+
+# bytes read at a time when hashing a csv file
+HASH_BLOCK = 1<<20
+
+
+def file_digest(path):
+    """
+        The sha1 hex digest of the contents of path.
+    """
+    digest = hashlib.sha1()
+    f = open(path,'rb')
+    try:
+        for data in iter(lambda: f.read(HASH_BLOCK),''):
+            digest.update(data)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+class StateStore(object):
+    """
+        The files converted and transactions exported to format, kept
+        in the SQLite database at path.
+
+        The exporters ask is_new(account, fitid) for each transaction.
+        The transactions that were new are only stored by commit(), once
+        the export is written; rollback() forgets them.
+    """
+    def __init__(self,path,format):
+        self.format = format
+        self.db = sqlite3.connect(path)
+        # the csv values are byte strings in any encoding
+        self.db.text_factory = str
+        self.db.execute("CREATE TABLE IF NOT EXISTS files "
+                        "(format TEXT, digest TEXT, PRIMARY KEY (format, digest))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS fitids "
+                        "(format TEXT, account TEXT, fitid TEXT, PRIMARY KEY (format, account, fitid))")
+        self.db.commit()
+        # the FITIDs of an account are loaded when it is first seen
+        self.known = {}
+        self.pending = []
+
+    def close(self):
+        self.db.close()
+
+    def converted(self,digest):
+        """
+            True if a csv file with the content hash digest was converted.
+        """
+        return self.db.execute("SELECT 1 FROM files WHERE format=? AND digest=?",
+                               (self.format,digest)).fetchone() is not None
+
+    def is_new(self,account,fitid):
+        """
+            True if the transaction fitid of account was not exported
+            before, it is remembered as exported then.
+        """
+        account, fitid = str(account), str(fitid)
+        known = self.known.get(account)
+        if known is None:
+            known = self.known[account] = set([row[0] for row in self.db.execute(
+                "SELECT fitid FROM fitids WHERE format=? AND account=?",(self.format,account))])
+        if fitid in known:
+            return False
+        known.add(fitid)
+        self.pending.append((self.format,account,fitid))
+        return True
+
+    def commit(self,digest):
+        """
+            Stores the new transactions and the converted file digest.
+        """
+        self.db.executemany("INSERT OR IGNORE INTO fitids VALUES (?,?,?)",self.pending)
+        self.db.execute("INSERT OR IGNORE INTO files VALUES (?,?)",(self.format,digest))
+        self.db.commit()
+        self.pending = []
+
+    def rollback(self):
+        """
+            Forgets the transactions since the last commit.
+        """
+        self.known = {}
+        self.pending = []
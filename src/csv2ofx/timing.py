@@ -0,0 +1,125 @@
+
+"""
+    Opt-in timing of conversions.
+
+    Set CSV2OFX_PROFILE to a file name (or use csv2ofx-batch --profile FILE)
+    and the time and the number of calls of each stage and of each mapping
+    field are recorded and written to that file as JSON at exit, e.g.:
+
+    {"seconds": 7.1,
+     "stages": {"load": {"calls": 1, "seconds": 0.8}, ...},
+     "fields": {"OFX.PAYEE": {"field": "<lambda>: yodlee_dscr", "calls": 196,
+                              "rows": 200000, "seconds": 1.2}, ...}}
+
+    The stages are load (reading the csv file), dates (the mapping's
+    Function_DateStrToDatetime), escape, format (the markup of each
+    transaction), collect (mapping the rows and formatting them, which
+    includes the fields) and write (the export file).  Times include the
+    time of the stages called within, e.g. a date field includes the
+    dates it parses.
+
+    Only the process that enabled the timing is recorded, not the worker
+    processes of --jobs or --row-jobs.  When the timing is off nothing is
+    wrapped, so it costs nothing.
+"""
+
+import os
+import time
+import atexit
+
+# the Profile being recorded, None when the timing is off
+profile = None
+
+
+class Profile(object):
+    """
+        The times recorded, written to path as JSON by write().
+    """
+    def __init__(self,path):
+        self.path = path
+        self.start = time.time()
+        self.stages = {}
+        self.fields = {}
+
+    def add_stage(self,name,seconds):
+        entry = self.stages.get(name)
+        if entry is None:
+            entry = self.stages[name] = {'calls':0, 'seconds':0.0}
+        entry['calls'] += 1
+        entry['seconds'] += seconds
+
+    def add_field(self,name,field,rows,seconds):
+        entry = self.fields.get(name)
+        if entry is None:
+            entry = self.fields[name] = {'field':field, 'calls':0, 'rows':0, 'seconds':0.0}
+        entry['calls'] += 1
+        entry['rows'] += rows
+        entry['seconds'] += seconds
+
+    def report(self):
+        return {'seconds':time.time()-self.start, 'stages':self.stages, 'fields':self.fields}
+
+    def write(self):
+        import json
+        f = open(self.path,'w')
+        try:
+            json.dump(self.report(),f,indent=2,sort_keys=True)
+        finally:
+            f.close()
+
+
+def enable(path):
+    """
+        Records the times from now on and writes them to path at exit.
+    """
+    global profile
+    profile = Profile(path)
+    atexit.register(profile.write)
+
+def stage(name,func):
+    """
+        func, adding the time of each call to the stage name when the
+        timing is on.
+    """
+    if profile is None:
+        return func
+    def timed(*args,**kwargs):
+        start = time.time()
+        try:
+            return func(*args,**kwargs)
+        finally:
+            profile.add_stage(name,time.time()-start)
+    return timed
+
+def describe(field):
+    """
+        What a mapping field is, for the report: the class of a declared
+        field, the function name of others, with the names a lambda uses
+        (e.g. '<lambda>: yodlee_dscr').
+    """
+    code = getattr(field,'func_code',None)
+    if code is None:
+        return field.__class__.__name__
+    if field.__name__ == '<lambda>' and code.co_names:
+        return '%s: %s' % (field.__name__, ', '.join(code.co_names))
+    return field.__name__
+
+def field(name,field,column):
+    """
+        The compiled column of field (see fields.compile_field), adding
+        its time and rows to the field name when the timing is on.
+    """
+    if profile is None:
+        return column
+    description = describe(field)
+    def timed(rows):
+        start = time.time()
+        try:
+            return column(rows)
+        finally:
+            profile.add_field(name,description,len(rows),time.time()-start)
+    return timed
+
+
+if os.environ.get('CSV2OFX_PROFILE'):
+    enable(os.environ['CSV2OFX_PROFILE'])